@@ -0,0 +1,131 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+import io
+import os
+import json
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from track import *
+from mfm import *
+from decoder import track_samples
+
+# samples of the track being tuned, shared with worker processes
+shared = {}
+
+
+# ------------------------------------------------------------------------
+def gap_histogram(samples):
+    edges = np.flatnonzero(samples[1:] & (samples[:-1] ^ 1))
+    return np.bincount(np.diff(edges))
+
+
+# ------------------------------------------------------------------------
+# Shortest MFM flux gap is two half-bit cells, so the first significant
+# histogram peak gives the clock period
+def seed_period(hist):
+    # no flux transitions to go by
+    if not len(hist) or not hist.max():
+        return 10
+    threshold = hist.max() / 10
+    for g in range(2, len(hist) - 1):
+        if hist[g] >= threshold and hist[g] >= hist[g-1] and hist[g] >= hist[g+1]:
+            return max(1, round(g / 2))
+    return 10
+
+
+# ------------------------------------------------------------------------
+# Parameter grid around the seed, ordered so that the most likely
+# candidates come first. Clock offset only shifts reported positions,
+# so it's not searched.
+def param_grid(period, spread=1):
+    grid = [
+        (p, m)
+        for p in range(max(1, period - spread), period + spread + 1)
+        for m in range(0, p // 2 + 1)
+    ]
+    return sorted(grid, key=lambda x: (abs(x[0] - period), abs(x[1] - 0.4 * x[0])))
+
+
+# ------------------------------------------------------------------------
+def worker_init(shm_name, length, sector_class, sectors):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    shared["shm"] = shm
+    shared["samples"] = np.ndarray((length,), dtype=np.uint8, buffer=shm.buf)
+    shared["sector_class"] = sector_class
+    shared["sectors"] = sectors
+
+
+# ------------------------------------------------------------------------
+def score(params):
+    (period, margin) = params
+    mfm_data = MFMDataNumpy(shared["samples"], period=period, margin=margin, offset=0)
+    track = Track(mfm_data, shared["sector_class"], shared["sectors"], event_cap=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        track.analyze()
+    good = sum(1 for (num, s) in track if s.head_crc_ok and s.data_crc_ok and not s.bad)
+    return good, params
+
+
+# ------------------------------------------------------------------------
+# Try clock parameters from the grid in parallel, stop as soon as all
+# sectors decode fine. Returns (good sectors, (period, margin)).
+def tune(file_name, sector_class, sectors, jobs=None, spread=1):
+    samples = np.concatenate(list(track_samples(file_name, mapped=True).chunks()) or [np.empty(0, dtype=np.uint8)])
+    grid = param_grid(seed_period(gap_histogram(samples)), spread)
+    rank = {params: i for (i, params) in enumerate(grid)}
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(samples)))
+    try:
+        np.ndarray((len(samples),), dtype=np.uint8, buffer=shm.buf)[:] = samples
+        best = (-1, grid[0])
+        with multiprocessing.Pool(jobs, initializer=worker_init, initargs=(shm.name, len(samples), sector_class, sectors)) as pool:
+            for result in pool.imap_unordered(score, grid):
+                # prefer more good sectors, then earlier (more likely) candidate
+                if (result[0] > best[0]) or (result[0] == best[0] and rank[result[1]] < rank[best[1]]):
+                    best = result
+                if best[0] >= sectors:
+                    pool.terminate()
+                    break
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return best
+
+
+# ------------------------------------------------------------------------
+def load_tuning(file_name):
+    try:
+        with open(file_name, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# ------------------------------------------------------------------------
+def save_tuning(file_name, tuning):
+    tmp_name = file_name + ".tmp"
+    with open(tmp_name, "w") as f:
+        json.dump(tuning, f, indent=1, sort_keys=True)
+    os.replace(tmp_name, file_name)
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
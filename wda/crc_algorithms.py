@@ -43,6 +43,19 @@ This is an example use of the different algorithms:
 >>> print("0x%x" % crc.bit_by_bit("123456789"))
 >>> print("0x%x" % crc.bit_by_bit_fast("123456789"))
 >>> print("0x%x" % crc.table_driven("123456789"))
+
+TableCrc works on bytes-like input, caches lookup tables per parameter set
+and can be updated incrementally:
+
+>>> from crc_algorithms import TableCrc
+>>>
+>>> crc = TableCrc(width = 16, poly = 0x1021,
+...           reflect_in = False, xor_in = 0xffff,
+...           reflect_out = False, xor_out = 0x0000)
+>>> print("0x%x" % crc.table_crc(b"123456789"))
+>>> reg = crc.update(crc.init(), b"1234")
+>>> reg = crc.update(reg, b"56789")
+>>> print("0x%x" % crc.final(reg))
 """
 
 # Class Crc
@@ -227,3 +240,87 @@ class Crc(object):
             register = self.reflect(register, self.Width)
         return register ^ self.XorOut
 
+
+# Class TableCrc
+###############################################################################
+class TableCrc(Crc):
+    """
+    Table-driven CRC for bytes-like input (bytes, bytearray, memoryview,
+    list of ints).  The lookup table is generated once for each set of
+    CRC parameters and shared between all instances.
+    """
+
+    # tables cache, indexed with (width, poly, reflect_in)
+    Tables = {}
+
+    # Class constructor
+    ###############################################################################
+    def __init__(self, width, poly, reflect_in, xor_in, reflect_out, xor_out):
+        """The TableCrc constructor.
+
+        The parameters are the same as for Crc, table index width is always 8.
+        """
+        Crc.__init__(self, width, poly, reflect_in, xor_in, reflect_out, xor_out)
+        key = (self.Width, self.Poly, self.ReflectIn)
+        try:
+            self.Table = TableCrc.Tables[key]
+        except KeyError:
+            self.Table = TableCrc.Tables[key] = self.gen_table()
+        self.Shift = self.Width - self.TableIdxWidth + self.CrcShift
+        self.ShiftedMask = self.Mask << self.CrcShift
+
+
+    # function init
+    ###############################################################################
+    def init(self):
+        """
+        return the initial register value to be used with update().
+        """
+        register = self.DirectInit << self.CrcShift
+        if self.ReflectIn:
+            register = self.reflect(register, self.Width + self.CrcShift) << self.CrcShift
+        return register
+
+
+    # function update
+    ###############################################################################
+    def update(self, register, data):
+        """
+        feed data into the register and return the new register value.
+        """
+        tbl = self.Table
+        mask = self.ShiftedMask
+        if not self.ReflectIn:
+            shift = self.Shift
+            lshift = self.TableIdxWidth - self.CrcShift
+            for c in data:
+                register = ((register << lshift) ^ tbl[((register >> shift) ^ c) & 0xff]) & mask
+        else:
+            crc_shift = self.CrcShift
+            for c in data:
+                register = ((register >> 8) ^ tbl[((register >> crc_shift) ^ c) & 0xff]) & mask
+        return register
+
+
+    # function final
+    ###############################################################################
+    def final(self, register):
+        """
+        return the CRC value for the register.
+        """
+        if not self.ReflectIn:
+            register = register >> self.CrcShift
+        else:
+            register = self.reflect(register, self.Width + self.CrcShift) & self.Mask
+        if self.ReflectOut:
+            register = self.reflect(register, self.Width)
+        return register ^ self.XorOut
+
+
+    # function table_crc
+    ###############################################################################
+    def table_crc(self, data):
+        """
+        return the CRC of bytes-like data.
+        """
+        return self.final(self.update(self.init(), data))
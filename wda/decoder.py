@@ -0,0 +1,299 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+import io
+import os
+import json
+import time
+import contextlib
+import numpy as np
+from wdsfile import *
+from wdffile import *
+from track import *
+from mfm import *
+from manifest import *
+from stats import *
+from diskimage import *
+
+MFM_ENGINES = {
+    "python": MFMData,
+    "numpy": MFMDataNumpy,
+    "cleanup": MFMDataCleanup,
+    "pll": MFMDataPLL,
+}
+
+
+# ------------------------------------------------------------------------
+def track_file_name(session, cylinder, head, ext="wds"):
+    return f"{session}--{cylinder:03}--{head}.{ext}"
+
+
+# ------------------------------------------------------------------------
+# Samples of a track file, .wdf files are read as flux transitions
+def track_samples(file_name, mapped=False):
+    if file_name.endswith(".wdf"):
+        return WDFFile(file_name)
+    return WDSFile(file_name, mapped=mapped)
+
+
+# ------------------------------------------------------------------------
+# Decode a track into .img file next to it, or into its place in a disk
+# image if one is given. If stats are given, they are collected during
+# decoding and written to .stats.json file.
+def decode_track(file_name, sector_class, sectors, period, margin, offset, engine="python", verbosity=0, merge=False, extra_files=(), stats=None, event_cap=1000, image=None, cylinder=0, head=0):
+    start = time.perf_counter()
+    track = None
+    for f in [file_name, *extra_files]:
+        samples = track_samples(f, mapped=(engine != "python"))
+        if stats:
+            stats.count("samples", len(samples))
+            samples = TimedSamples(samples, stats)
+        mfm_data = MFM_ENGINES[engine](samples, period=period, margin=margin, offset=offset)
+        if track is None:
+            track = Track(mfm_data, sector_class, sectors, verbosity=verbosity, merge=merge, stats=stats, event_cap=event_cap)
+        else:
+            track.add_capture(mfm_data)
+    if stats:
+        with stats.timer("analyze"):
+            sector_status = track.analyze()
+    else:
+        sector_status = track.analyze()
+
+    save_sector_index(file_name, [file_name, *extra_files], sector_class, track)
+
+    if image:
+        missing_sectors = image.write_track(cylinder, head, track)
+    else:
+        missing_sectors = 0
+        with open(image_file_name(file_name), "wb") as outf:
+            for i in range(0, sectors):
+                try:
+                    outf.write(bytes(track.sector(i)))
+                except KeyError:
+                    # fill with dummy data
+                    outf.write(bytes(256 * [0xff, 0]))
+                    missing_sectors += 1
+
+    if stats:
+        stats.add_time("total", time.perf_counter() - start)
+        stats.info.update({"file": file_name, "format": sector_class.__name__, "engine": engine, "merge": merge, "missing": missing_sectors, "events": track.events.as_dict()})
+        stats.save(os.path.splitext(file_name)[0] + ".stats.json")
+
+    return track, sector_status, missing_sectors
+
+
+# ------------------------------------------------------------------------
+# Sidecar with locations of all sectors found in a track, see Track.locate()
+def sector_index_file_name(track_file):
+    return os.path.splitext(track_file)[0] + ".sectors.json"
+
+
+# ------------------------------------------------------------------------
+# Index also holds results of sectors written to the .img (after merging
+# copies), so a worse copy decoded later doesn't replace a good sector
+def save_sector_index(file_name, files, sector_class, track):
+    index = {
+        "format": sector_class.__name__,
+        "files": files,
+        "hashes": [file_hash(f) for f in files],
+        "sectors": track.locations,
+        "results": sector_results(track),
+    }
+    store_sector_index(file_name, index)
+
+
+# ------------------------------------------------------------------------
+def store_sector_index(file_name, index):
+    index = dict(index, files=[os.path.basename(f) for f in index["files"]])
+    index.pop("samples", None)
+    with open(sector_index_file_name(file_name), "w") as f:
+        json.dump(index, f, indent=1)
+
+
+# ------------------------------------------------------------------------
+# Index with captures opened, None if there is no index or any of the
+# captures has changed
+def load_sector_index(file_name):
+    try:
+        with open(sector_index_file_name(file_name), "r") as f:
+            index = json.load(f)
+        directory = os.path.dirname(file_name)
+        index["files"] = [os.path.join(directory, f) for f in index["files"]]
+        if [file_hash(f) for f in index["files"]] != index["hashes"]:
+            return None
+        index["samples"] = [track_samples(f, mapped=True) for f in index["files"]]
+    except (OSError, ValueError, KeyError):
+        return None
+    return index
+
+
+# ------------------------------------------------------------------------
+# Samples from start to end, only that part of a .wds file is unpacked
+def sample_window(samples, start, end):
+    if isinstance(samples, WDSFile):
+        first = start // 8
+        s = np.unpackbits(np.frombuffer(samples.buffer[first:(end + 7) // 8], dtype=np.uint8))
+        return s[start - 8*first:end - 8*first]
+    return samples.window(start, end)
+
+
+# cells before the header field (sync, A1 and some slack) and after sector end
+WINDOW_LEAD = 240
+WINDOW_TAIL = 16
+
+
+# ------------------------------------------------------------------------
+# Decode a single sector again from windows of samples around all places
+# it was found at before, as recorded in the sector index (see
+# load_sector_index()). Copies are merged as in Track.analyze_merge().
+# Returns the merged sector, or None if no copy was decoded.
+def decode_sector(index, num, sector_class, period, margin, offset, engine="numpy", verbosity=0, event_cap=1000):
+    # python engine has no cell buffer, numpy one gives the same cells
+    mfm_class = MFM_ENGINES[engine] if engine != "python" else MFMDataNumpy
+    copies = []
+    for location in index["sectors"]:
+        if location["sector"] != num or "header" not in location or "end" not in location:
+            continue
+        samples = index["samples"][location["capture"]]
+        start = max(0, location["header"][1] - WINDOW_LEAD * period)
+        end = min(len(samples), location["end"][1] + WINDOW_TAIL * period)
+        (values, positions) = mfm_class(sample_window(samples, start, end), period=period, margin=margin, offset=offset).cells()
+
+        track = Track(RecoveredCells(values, positions + start), sector_class, 1, verbosity=verbosity, event_cap=event_cap)
+        with contextlib.redirect_stdout(io.StringIO()) if not verbosity else contextlib.nullcontext():
+            track.analyze()
+        if num in track.sectors:
+            copies.append(track.sectors[num])
+
+    if not copies:
+        return None
+    return track.merge_copies(copies)
+
+
+# ------------------------------------------------------------------------
+# Order of sector results: header CRC, data CRC, not marked bad
+def sector_rank(head_crc, data_crc, bad):
+    return head_crc, data_crc, not bad
+
+
+# ------------------------------------------------------------------------
+# Replace one sector in track's .img file, unless the sector index says
+# the one that is there is better. Returns True if sector was written.
+def write_sector(index, file_name, num, sector, sectors):
+    result = {"head_crc": sector.head_crc_ok, "data_crc": sector.data_crc_ok, "bad": sector.bad}
+    previous = index.get("results", {}).get(str(num))
+    if previous and sector_rank(**previous) > sector_rank(**result):
+        return False
+
+    data = bytes(sector)
+    img_name = image_file_name(file_name)
+    if not os.path.exists(img_name):
+        with open(img_name, "wb") as f:
+            f.write(bytes(256 * [0xff, 0]) * sectors)
+    with open(img_name, "r+b") as f:
+        f.seek(num * len(data))
+        f.write(data)
+
+    index.setdefault("results", {})[str(num)] = result
+    store_sector_index(file_name, index)
+    return True
+
+
+# ------------------------------------------------------------------------
+def sector_results(track):
+    return {
+        str(num): {"head_crc": s.head_crc_ok, "data_crc": s.data_crc_ok, "bad": s.bad}
+        for (num, s) in track
+    }
+
+
+# ------------------------------------------------------------------------
+# Clock parameters for a track: tuned ones if there are any (see wdatune),
+# otherwise as given in args
+def clock_params(file_name, args, tuning):
+    t = tuning.get(os.path.basename(file_name), {})
+    return t.get("clock", args.clock), t.get("margin", args.margin), t.get("offset", args.offset)
+
+
+# ------------------------------------------------------------------------
+# Task for decode_task() to decode a track from its captures, using
+# decoding options from wdabatch/wdawatch command line args. Manifest
+# entry from the last decode is passed on, unless decoding is forced.
+def make_task(cylinder, head, files, sector_class, args, tuning, manifest):
+    previous = manifest.get(files[0]) if manifest and not args.force else None
+    return (
+        cylinder, head, files, sector_class, args.sectors, *clock_params(files[0], args, tuning),
+        args.engine, args.verbose, args.merge, args.stats, args.max_events, previous, args.image
+    )
+
+
+# disk images opened by a worker process, by file name
+disk_images = {}
+
+
+# ------------------------------------------------------------------------
+def disk_image(file_name):
+    if file_name not in disk_images:
+        disk_images[file_name] = DiskImage(file_name)
+    return disk_images[file_name]
+
+
+# ------------------------------------------------------------------------
+# Decode one track in a worker process, output is captured and returned
+# to be printed in order by the caller. Track is skipped if the previous
+# manifest entry matches both the file contents and decoding parameters
+# (and the track is already in the disk image, if decoding into one).
+def decode_task(task):
+    (cylinder, head, file_names, sector_class, sectors, period, margin, offset, engine, verbosity, merge, stats, event_cap, previous, image_name) = task
+    (file_name, *extra_files) = file_names
+
+    params = {"format": sector_class.__name__, "sectors": sectors, "engine": engine, "clock": period, "margin": margin, "offset": offset, "merge": merge}
+    entry = None
+    skipped = False
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            image = disk_image(image_name) if image_name else None
+            fhash = "+".join([file_hash(f) for f in file_names])
+            if Manifest.up_to_date(previous, file_name, fhash, params, image.has_track(cylinder, head) if image else None):
+                entry = previous
+                skipped = True
+            else:
+                (track, sector_status, missing_sectors) = decode_track(file_name, sector_class, sectors, period, margin, offset, engine, verbosity, merge, extra_files, Stats() if stats else None, event_cap, image, cylinder, head)
+                if missing_sectors:
+                    print(f" * {missing_sectors} sectors missing")
+                entry = {
+                    "hash": fhash,
+                    "params": params,
+                    "ok": bool(sector_status and not missing_sectors),
+                    "missing": missing_sectors,
+                    "sectors": sector_results(track),
+                    "events": track.events.as_dict(),
+                }
+            (ok, missing_sectors) = (entry["ok"], entry["missing"])
+        except FileNotFoundError as e:
+            print(f" * File not found: {e.filename}")
+            (ok, missing_sectors) = (False, sectors)
+        except Exception as e:
+            print(f" * Decoding failed: {e!r}")
+            (ok, missing_sectors) = (False, sectors)
+
+    return cylinder, head, ok, missing_sectors, out.getvalue(), entry, skipped
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
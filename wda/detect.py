@@ -0,0 +1,100 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import multiprocessing
+import numpy as np
+from decoder import *
+
+# cells of the track prefix being checked, shared with worker processes
+shared = {}
+
+# a few sectors of a typical track
+DETECT_CELLS = 50000
+
+
+# ------------------------------------------------------------------------
+def worker_init(values, positions, sectors, merge):
+    shared["cells"] = RecoveredCells(values, positions)
+    shared["sectors"] = sectors
+    shared["merge"] = merge
+
+
+# ------------------------------------------------------------------------
+# Scan the prefix the same way the track would be decoded (without
+# merging decoding stops on the first sector not found in time) and
+# count headers and data fields that passed CRC check
+def score(name):
+    track = Track(shared["cells"], SECTOR_FORMATS[name], shared["sectors"], merge=shared["merge"], event_cap=0)
+    head_ok = 0
+    data_ok = 0
+    for (res, sector) in track.all_sectors():
+        if res == State.FAILED and not shared["merge"]:
+            break
+        if res == State.DONE and sector.head_crc_ok:
+            head_ok += 1
+            data_ok += sector.data_crc_ok
+    return name, head_ok, data_ok
+
+
+# ------------------------------------------------------------------------
+# Try all sector formats on already recovered cells. Returns (format
+# name, header CRCs OK, data CRCs OK) for all formats, best one first.
+def detect_format(values, positions, sectors, merge=False, formats=SECTOR_FORMATS, jobs=None):
+    if jobs == 1:
+        worker_init(values, positions, sectors, merge)
+        results = [score(name) for name in formats]
+    else:
+        with multiprocessing.Pool(min(jobs or len(formats), len(formats)), initializer=worker_init, initargs=(values, positions, sectors, merge)) as pool:
+            results = pool.map(score, list(formats))
+
+    # most headers first, then most data, then the order formats are given in
+    order = list(formats)
+    return sorted(results, key=lambda x: (-x[1], -x[2], order.index(x[0])))
+
+
+# ------------------------------------------------------------------------
+# Recover the clock once, only for as many samples as needed for prefix
+# cells, and try all sector formats on that
+def detect_track(file_name, sectors, period, margin, offset, engine="numpy", merge=False, formats=SECTOR_FORMATS, prefix=DETECT_CELLS, jobs=None):
+    # python engine has no cell buffer, numpy one gives the same cells
+    mfm_class = MFM_ENGINES[engine] if engine != "python" else MFMDataNumpy
+    chunks = []
+    length = 0
+    for chunk in track_samples(file_name, mapped=True).chunks():
+        chunks.append(chunk)
+        length += len(chunk)
+        if length >= (prefix + 1) * max(period, 1) * 2:
+            break
+    samples = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.uint8)
+
+    (values, positions) = mfm_class(samples, period=period, margin=margin, offset=offset).cells()
+    return detect_format(values[:prefix], positions[:prefix], sectors, merge, formats, jobs)
+
+
+# ------------------------------------------------------------------------
+def detection_summary(results):
+    (name, head_ok, data_ok) = results[0]
+    if not head_ok:
+        return "Sector format not detected, no sector header found"
+    summary = f"Detected format: {name} (header CRC OK: {head_ok}, data CRC OK: {data_ok})"
+    same = [r[0] for r in results[1:] if r[1:] == results[0][1:]]
+    if same:
+        summary += f", same results for: {', '.join(same)}"
+    return summary
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
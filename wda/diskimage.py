@@ -0,0 +1,204 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+import os
+import mmap
+import fcntl
+import contextlib
+import struct
+import numpy as np
+
+STATUS_HEADER = struct.Struct("<4sHHHHI")
+STATUS_MAGIC = b"WDST"
+STATUS_VERSION = 1
+
+# sector status flags, 0 means the sector is fine
+HEAD_CRC_ERROR = 0x01
+DATA_CRC_ERROR = 0x02
+BAD = 0x04
+MISSING = 0x08
+
+# data written for sectors that are missing
+FILLER = bytes([0xff, 0])
+
+
+# ------------------------------------------------------------------------
+def status_file_name(image_file):
+    return image_file + ".status"
+
+
+# ------------------------------------------------------------------------
+def sector_status(sector):
+    status = 0
+    if not sector.head_crc_ok:
+        status |= HEAD_CRC_ERROR
+    if not sector.data_crc_ok:
+        status |= DATA_CRC_ERROR
+    if sector.bad:
+        status |= BAD
+    return status
+
+
+# ------------------------------------------------------------------------
+# Sector status order: missing, then by errors, OK is the best
+def status_rank(status):
+    return not status & MISSING, not status & HEAD_CRC_ERROR, not status & DATA_CRC_ERROR, not status & BAD
+
+
+# ------------------------------------------------------------------------
+def status_str(status):
+    if status & MISSING:
+        return "missing"
+    names = [n for (flag, n) in [(HEAD_CRC_ERROR, "header CRC"), (DATA_CRC_ERROR, "data CRC"), (BAD, "bad")] if status & flag]
+    return ", ".join(names) if names else "OK"
+
+
+# ------------------------------------------------------------------------
+# Whole disk image in C/H/S order, with one status byte per sector kept
+# in a .status file next to it. Both files are memory-mapped, so tracks
+# can be written straight to their place from several processes at once.
+# A sector is never replaced by a worse one, so captures of the same
+# track from several sessions can be decoded into the image in any order,
+# while a decode as good as what's there (a rerun with other clock
+# parameters, votes) still replaces it.
+class DiskImage:
+
+    # --------------------------------------------------------------------
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.status_file = open(status_file_name(file_name), "r+b")
+        self.status_map = mmap.mmap(self.status_file.fileno(), 0)
+        if len(self.status_map) < STATUS_HEADER.size:
+            raise ValueError(f"{file_name}: damaged status file")
+        (magic, version, self.cylinders, self.heads, self.sectors, self.sector_size) = STATUS_HEADER.unpack_from(self.status_map)
+        if magic != STATUS_MAGIC or version != STATUS_VERSION:
+            raise ValueError(f"{file_name}: not a disk image status file (or unsupported version)")
+        count = self.cylinders * self.heads * self.sectors
+        if len(self.status_map) != STATUS_HEADER.size + count:
+            raise ValueError(f"{file_name}: damaged status file")
+        self.status = np.frombuffer(self.status_map, dtype=np.uint8, offset=STATUS_HEADER.size).reshape(self.cylinders, self.heads, self.sectors)
+
+        with open(file_name, "r+b") as f:
+            self.data = mmap.mmap(f.fileno(), 0)
+        if len(self.data) != count * self.sector_size:
+            raise ValueError(f"{file_name}: image size does not match its geometry")
+
+    # --------------------------------------------------------------------
+    # Preallocate the image filled with dummy data and all sectors missing.
+    # Status file is written last, so an image with one is always complete.
+    @staticmethod
+    def create(file_name, cylinders, heads, sectors, sector_size=512):
+        count = cylinders * heads * sectors
+        tmp_name = file_name + ".tmp"
+        with open(tmp_name, "wb") as f:
+            f.truncate(count * sector_size)
+        if count:
+            with open(tmp_name, "r+b") as f, mmap.mmap(f.fileno(), 0) as m:
+                np.frombuffer(m, dtype=np.uint8)[:] = np.resize(np.frombuffer(FILLER, dtype=np.uint8), count * sector_size)
+        os.replace(tmp_name, file_name)
+
+        status_name = status_file_name(file_name)
+        with open(status_name + ".tmp", "wb") as f:
+            f.write(STATUS_HEADER.pack(STATUS_MAGIC, STATUS_VERSION, cylinders, heads, sectors, sector_size))
+            f.write(bytes([MISSING]) * count)
+        os.replace(status_name + ".tmp", status_name)
+        return DiskImage(file_name)
+
+    # --------------------------------------------------------------------
+    # Open an existing image, or create one if there is none. Geometry
+    # has to match the existing image.
+    @staticmethod
+    def open(file_name, cylinders, heads, sectors, sector_size=512):
+        if not os.path.exists(status_file_name(file_name)):
+            return DiskImage.create(file_name, cylinders, heads, sectors, sector_size)
+        image = DiskImage(file_name)
+        if image.geometry() != (cylinders, heads, sectors, sector_size):
+            raise ValueError(f"{file_name}: image geometry {image.geometry()} does not match {(cylinders, heads, sectors, sector_size)}")
+        return image
+
+    # --------------------------------------------------------------------
+    def geometry(self):
+        return self.cylinders, self.heads, self.sectors, self.sector_size
+
+    # --------------------------------------------------------------------
+    def offset(self, cylinder, head, sector):
+        return ((cylinder * self.heads + head) * self.sectors + sector) * self.sector_size
+
+    # --------------------------------------------------------------------
+    # Lock track's status bytes for processes writing the same track
+    @contextlib.contextmanager
+    def track_lock(self, cylinder, head):
+        start = STATUS_HEADER.size + (cylinder * self.heads + head) * self.sectors
+        fcntl.lockf(self.status_file, fcntl.LOCK_EX, self.sectors, start)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.status_file, fcntl.LOCK_UN, self.sectors, start)
+
+    # --------------------------------------------------------------------
+    # Write the sector unless the one in the image is better (see
+    # status_rank()). Returns True if sector was written.
+    def write_sector(self, cylinder, head, sector, data, status):
+        if len(data) != self.sector_size:
+            raise ValueError(f"Sector {cylinder}/{head}/{sector}: {len(data)} bytes, image has {self.sector_size}-byte sectors")
+        if status_rank(status) < status_rank(self.status[cylinder, head, sector]):
+            return False
+        pos = self.offset(cylinder, head, sector)
+        self.data[pos:pos + self.sector_size] = data
+        self.status[cylinder, head, sector] = status
+        return True
+
+    # --------------------------------------------------------------------
+    # Write all sectors of a decoded track that are not worse than the
+    # ones in the image. Returns number of sectors missing in the track.
+    def write_track(self, cylinder, head, track):
+        missing = 0
+        with self.track_lock(cylinder, head):
+            for s in range(0, self.sectors):
+                try:
+                    sector = track.sector(s)
+                    self.write_sector(cylinder, head, s, bytes(sector), sector_status(sector))
+                except KeyError:
+                    missing += 1
+        return missing
+
+    # --------------------------------------------------------------------
+    # Track was written at least once (has any sector that is not missing)
+    def has_track(self, cylinder, head):
+        return bool((self.status[cylinder, head] != MISSING).any())
+
+    # --------------------------------------------------------------------
+    # (cylinder, head, sector, status) of all sectors that are not fine
+    def bad_sectors(self):
+        for (c, h, s) in np.argwhere(self.status != 0).tolist():
+            yield c, h, s, int(self.status[c, h, s])
+
+    # --------------------------------------------------------------------
+    def flush(self):
+        self.data.flush()
+        self.status_map.flush()
+
+    # --------------------------------------------------------------------
+    def close(self):
+        self.status = None
+        self.status_map.close()
+        self.status_file.close()
+        self.data.close()
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
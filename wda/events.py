@@ -0,0 +1,108 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import numpy as np
+
+
+# ------------------------------------------------------------------------
+# Decoding diagnostics collected while analyzing a track. Each event is
+# a (kind, sample position, phase name, sector number) tuple, sector
+# number is None until sector header is decoded. Events over the cap are
+# only counted, formatting is left for when (and if) they're reported.
+class Events:
+
+    # kinds 1-3 are ByteReader violation kinds
+    ILLEGAL_11 = 1
+    ILLEGAL_00 = 2
+    ILLEGAL_10 = 3
+    DEADLINE = 4
+
+    NAMES = {
+        ILLEGAL_11: "illegal cell 11",
+        ILLEGAL_00: "illegal cell 00 after 0",
+        ILLEGAL_10: "illegal cell 10 after 1",
+        DEADLINE: "deadline missed",
+    }
+
+    # --------------------------------------------------------------------
+    def __init__(self, cap=1000):
+        self.cap = cap
+        self.buffer = []
+        self.counts = {}
+        self.sector = None
+
+    # --------------------------------------------------------------------
+    def add(self, kind, position, phase):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        if len(self.buffer) < self.cap:
+            self.buffer.append((kind, position, phase, self.sector))
+
+    # --------------------------------------------------------------------
+    # Add events from NumPy arrays of kinds and positions
+    def add_many(self, kinds, positions, phase):
+        for (kind, count) in enumerate(np.bincount(kinds).tolist()):
+            if count:
+                self.counts[kind] = self.counts.get(kind, 0) + count
+        room = self.cap - len(self.buffer)
+        if room > 0:
+            self.buffer.extend(
+                (k, p, phase, self.sector)
+                for (k, p) in zip(kinds[:room].tolist(), positions[:room].tolist())
+            )
+
+    # --------------------------------------------------------------------
+    def total(self):
+        return sum(self.counts.values())
+
+    # --------------------------------------------------------------------
+    def dropped(self):
+        return self.total() - len(self.buffer)
+
+    # --------------------------------------------------------------------
+    @staticmethod
+    def format(event):
+        (kind, position, phase, sector) = event
+        where = f"sector {sector}, " if sector is not None else ""
+        if kind == Events.DEADLINE:
+            return f" * Could not find bit sequence within given deadline ({where}{phase}) at sample: {position}"
+        else:
+            kind_name = Events.NAMES[kind].replace("illegal cell ", "")
+            return f" * MFM illegal cell: {kind_name} ({where}{phase}) at sample: {position}"
+
+    # --------------------------------------------------------------------
+    def summary(self):
+        return ", ".join([
+            f"{Events.NAMES[kind]}: {count}"
+            for (kind, count) in sorted(self.counts.items())
+        ])
+
+    # --------------------------------------------------------------------
+    def report(self, verbosity=0):
+        if verbosity:
+            for event in self.buffer:
+                print(Events.format(event))
+            if self.dropped():
+                print(f" * {self.dropped()} more events not shown")
+        if self.counts:
+            print(f" * Events: {self.summary()}")
+
+    # --------------------------------------------------------------------
+    def as_dict(self):
+        return {Events.NAMES[kind]: count for (kind, count) in sorted(self.counts.items())}
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
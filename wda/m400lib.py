@@ -1,4 +1,4 @@
-import struct
+import numpy as np
 
 # ------------------------------------------------------------------------
 def r2a(i):
@@ -26,22 +26,40 @@ def r40_triplet(w):
     ]
     return ''.join(triplet)
 
+# ------------------------------------------------------------------------
+# R40 strings and characters for all 16-bit words, built on first use
+R40_TABLE = None
+R40_CHARS = None
+
+def r40_table():
+    global R40_TABLE
+    if R40_TABLE is None:
+        R40_TABLE = [r40_triplet(w) for w in range(0x10000)]
+    return R40_TABLE
+
+def r40_chars():
+    global R40_CHARS
+    if R40_CHARS is None:
+        chars = np.frombuffer(''.join([r2a(i) for i in range(0, 40)]).encode(), dtype=np.uint8)
+        w = np.arange(0x10000)
+        R40_CHARS = np.stack((chars[(w // 1600) % 40], chars[(w // 40) % 40], chars[w % 40]), axis=1)
+    return R40_CHARS
+
 # ------------------------------------------------------------------------
 def r40_str(words):
-    chars = [r40_triplet(w) for w in words]
+    table = r40_table()
+    chars = [table[w] for w in words]
     return ''.join(chars)
 
+# ------------------------------------------------------------------------
+def words(data):
+    return np.frombuffer(data, dtype=">u2", count=len(data) // 2)
+
 # ------------------------------------------------------------------------
 def wload(ifile, offset, ilen):
-    f = open(ifile, "rb")
-    f.seek(offset)
-    odata = []
-    pos = 0
-    while pos < ilen:
-        data = struct.unpack('!H', f.read(2))[0]
-        odata.append(data)
-        pos += 1;
-    f.close();
-    return odata
+    odata = np.fromfile(ifile, dtype=">u2", count=ilen, offset=offset)
+    if len(odata) < ilen:
+        raise EOFError(f"{ifile}: {ilen} words requested at offset {offset}, only {len(odata)} available")
+    return odata.tolist()
 
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
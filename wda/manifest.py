@@ -0,0 +1,93 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+import os
+import json
+import hashlib
+
+
+# ------------------------------------------------------------------------
+def file_hash(file_name):
+    h = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# ------------------------------------------------------------------------
+# Decoded sector image of a track file
+def image_file_name(track_file):
+    return os.path.splitext(track_file)[0] + ".img"
+
+
+# ------------------------------------------------------------------------
+# JSON sidecar with decoding results of track files, indexed by file name.
+# Each entry holds file hash, decoding parameters, track status and
+# per-sector CRC results.
+class Manifest:
+
+    # --------------------------------------------------------------------
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.tracks = {}
+        try:
+            with open(file_name, "r") as f:
+                self.tracks = json.load(f)["tracks"]
+        except FileNotFoundError:
+            pass
+
+    # --------------------------------------------------------------------
+    def get(self, track_file):
+        return self.tracks.get(os.path.basename(track_file))
+
+    # --------------------------------------------------------------------
+    def update(self, track_file, entry):
+        self.tracks[os.path.basename(track_file)] = entry
+
+    # --------------------------------------------------------------------
+    def save(self):
+        # write a new file and replace the old one, so an interrupted run
+        # always leaves a valid manifest behind
+        tmp_name = self.file_name + ".tmp"
+        with open(tmp_name, "w") as f:
+            json.dump({"tracks": self.tracks}, f, indent=1, sort_keys=True)
+        os.replace(tmp_name, self.file_name)
+
+    # --------------------------------------------------------------------
+    def bad_sectors(self):
+        for (track_file, entry) in sorted(self.tracks.items()):
+            for (num, s) in entry["sectors"].items():
+                if not s["head_crc"] or not s["data_crc"] or s["bad"]:
+                    yield track_file, int(num)
+
+    # --------------------------------------------------------------------
+    # in_image tells if the track is already there, when decoding into a disk image
+    @staticmethod
+    def up_to_date(entry, track_file, fhash, params, in_image=None):
+        if not entry:
+            return False
+        if entry["hash"] != fhash or entry["params"] != params:
+            return False
+        # decoded image needs to be there too
+        if in_image is not None:
+            return in_image
+        return os.path.exists(image_file_name(track_file))
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
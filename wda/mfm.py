@@ -15,6 +15,8 @@
 #  Foundation, Inc.,
 #  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import abc
+import numpy as np
 
 # ------------------------------------------------------------------------
 class MFMData:
@@ -26,8 +28,31 @@ class MFMData:
         self.offset = offset
         self.samples = samples
 
+    # --------------------------------------------------------------------
+    # Same clock, but run per flux transition for sources that have them
+    def __flux(self):
+        p = self.period
+        m = self.margin
+        n = len(self.samples)
+        pulse_end = self.samples.first_high
+        next_clock = p
+
+        for (e, w) in zip(self.samples.edges().tolist() + [n], self.samples.widths().tolist() + [0]):
+            # ticks are due margin samples after the clock, before the next edge
+            while next_clock + m < e:
+                yield (next_clock + self.offset, next_clock + m < pulse_end)
+                next_clock += p
+            if e < n:
+                yield (e + self.offset, True)
+                next_clock = e + p
+                pulse_end = e + w
+
     # --------------------------------------------------------------------
     def __iter__(self):
+        if hasattr(self.samples, "edges") and self.period >= 1 and self.period + self.margin >= 1:
+            yield from self.__flux()
+            return
+
         ticks = []
         ov = -1
         t = 0
@@ -48,4 +73,332 @@ class MFMData:
             t += 1
 
 
+# ------------------------------------------------------------------------
+# Contiguous buffer of half-bit cells: values, sample positions and raw
+# bytes of values for bulk searches
+class MFMCells:
+
+    # --------------------------------------------------------------------
+    def __init__(self, values, positions):
+        self.values = values
+        self.positions = positions
+        self.raw = values.tobytes()
+        self.__values_list = None
+        self.__positions_list = None
+
+    # --------------------------------------------------------------------
+    def values_list(self):
+        if self.__values_list is None:
+            self.__values_list = self.values.tolist()
+        return self.__values_list
+
+    # --------------------------------------------------------------------
+    def positions_list(self):
+        if self.__positions_list is None:
+            self.__positions_list = self.positions.tolist()
+        return self.__positions_list
+
+    # --------------------------------------------------------------------
+    def __len__(self):
+        return len(self.values)
+
+
+# ------------------------------------------------------------------------
+# Cells already recovered by a clock recovery engine
+class RecoveredCells:
+
+    # --------------------------------------------------------------------
+    def __init__(self, values, positions):
+        self.values = values
+        self.positions = positions
+
+    # --------------------------------------------------------------------
+    def cells(self):
+        return self.values, self.positions
+
+    # --------------------------------------------------------------------
+    def __iter__(self):
+        return zip(self.positions.tolist(), self.values.tolist())
+
+
+# ------------------------------------------------------------------------
+# Base for clock recovery strategies working on whole sample arrays.
+# recover() returns half-bit cell values and their sample positions,
+# iterating yields (t, v) tuples, just like MFMData.
+class ClockRecovery(abc.ABC):
+
+    # --------------------------------------------------------------------
+    def __init__(self, samples, period, margin, offset):
+        self.period = period
+        self.margin = margin
+        self.offset = offset
+        self.samples = samples
+        self.values = None
+        self.positions = None
+
+    # --------------------------------------------------------------------
+    def sample_chunks(self):
+        if isinstance(self.samples, np.ndarray):
+            return [self.samples]
+        elif hasattr(self.samples, "chunks"):
+            return self.samples.chunks()
+        else:
+            return [np.fromiter(self.samples, dtype=np.uint8)]
+
+    # --------------------------------------------------------------------
+    def sample_array(self):
+        chunks = list(self.sample_chunks())
+        if not chunks:
+            return np.empty(0, dtype=np.uint8)
+        return np.concatenate(chunks).astype(np.uint8, copy=False)
+
+    # --------------------------------------------------------------------
+    # Rising edges and number of samples, taken straight from flux
+    # transitions if the source has them
+    def edge_array(self):
+        if hasattr(self.samples, "edges"):
+            return self.samples.edges(), len(self.samples)
+        s = self.sample_array()
+        return self.rising_edges(s), len(s)
+
+    # --------------------------------------------------------------------
+    @staticmethod
+    def rising_edges(s):
+        # no edge on the very first sample
+        return np.flatnonzero(s[1:] & (s[:-1] ^ 1)) + 1
+
+    # --------------------------------------------------------------------
+    @abc.abstractmethod
+    def recover(self):
+        pass
+
+    # --------------------------------------------------------------------
+    def cells(self):
+        if self.values is None:
+            (self.values, self.positions) = self.recover()
+        return self.values, self.positions
+
+    # --------------------------------------------------------------------
+    def __iter__(self):
+        (values, positions) = self.cells()
+        return zip(positions.tolist(), values.tolist())
+
+
+# ------------------------------------------------------------------------
+# Same clock recovery as MFMData, but done with NumPy for a whole block
+# of samples at once.
+class MFMDataNumpy(ClockRecovery):
+
+    # --------------------------------------------------------------------
+    def __block(self, s, base, state):
+        (ov, next_clock) = state
+        p = self.period
+
+        # rising edges (ov is a sample from the previous block)
+        prev = np.empty_like(s)
+        prev[0] = ov
+        prev[1:] = s[:-1]
+        edges = np.flatnonzero(s & (prev ^ 1)) + base
+
+        # each edge starts a segment with its first clock at edge + period,
+        # first segment continues the clock from the previous block
+        clk0 = np.concatenate(([next_clock], edges + p))
+        bound = np.concatenate((edges, [base + len(s)]))
+        is_edge = np.ones(len(clk0), dtype=np.int64)
+        is_edge[0] = 0
+
+        # ticks are emitted at clock + margin, as long as it's before segment end
+        ticks = np.maximum((bound - clk0 - self.margin - 1) // p + 1, 0)
+        count = ticks + is_edge
+        seg = np.repeat(np.arange(len(clk0)), count)
+        idx = np.arange(len(seg)) - np.repeat(np.cumsum(count) - count, count) - is_edge[seg]
+
+        # idx == -1 is the edge itself
+        clock = clk0[seg] + idx * p
+        emit = clock + np.where(idx >= 0, self.margin, 0)
+
+        values = s[emit - base]
+        positions = clock + self.offset
+
+        return values, positions, (int(s[-1]), int(clk0[-1] + ticks[-1] * p))
+
+    # --------------------------------------------------------------------
+    def blocks(self):
+        # no edge on the very first sample, just like in MFMData
+        state = (1, self.period)
+        base = 0
+        for s in self.sample_chunks():
+            if not len(s):
+                continue
+            s = s.astype(np.uint8, copy=False)
+            values, positions, state = self.__block(s, base, state)
+            base += len(s)
+            yield values, positions
+
+    # --------------------------------------------------------------------
+    # Whole track at once from flux transitions: sample values at tick
+    # times come from the pulse that started at segment's edge
+    def __flux(self):
+        p = self.period
+        edges = self.samples.edges()
+        n = len(self.samples)
+
+        clk0 = np.concatenate(([p], edges + p))
+        bound = np.concatenate((edges, [n]))
+        pulse_end = np.concatenate(([self.samples.first_high], edges + self.samples.widths()))
+        is_edge = np.ones(len(clk0), dtype=np.int64)
+        is_edge[0] = 0
+
+        ticks = np.maximum((bound - clk0 - self.margin - 1) // p + 1, 0)
+        count = ticks + is_edge
+        seg = np.repeat(np.arange(len(clk0)), count)
+        idx = np.arange(len(seg)) - np.repeat(np.cumsum(count) - count, count) - is_edge[seg]
+
+        clock = clk0[seg] + idx * p
+        emit = clock + np.where(idx >= 0, self.margin, 0)
+
+        values = (emit < pulse_end[seg]).astype(np.uint8)
+        return values, clock + self.offset
+
+    # --------------------------------------------------------------------
+    def recover(self):
+        if hasattr(self.samples, "edges") and self.period >= 1 and self.period + self.margin >= 1:
+            return self.__flux()
+        if self.period < 1 or self.period + self.margin < 1:
+            # ticks can't be computed in bulk, fall back to the generator
+            t = list(MFMData(self.samples, self.period, self.margin, self.offset))
+            positions = np.array([x[0] for x in t], dtype=np.int64)
+            values = np.array([x[1] for x in t], dtype=np.uint8)
+        else:
+            v = []
+            p = []
+            for (values, positions) in self.blocks():
+                v.append(values)
+                p.append(positions)
+            values = np.concatenate(v) if v else np.empty(0, dtype=np.uint8)
+            positions = np.concatenate(p) if p else np.empty(0, dtype=np.int64)
+        return values, positions
+
+
+# ------------------------------------------------------------------------
+# Clock recovery used by mfmview: rising edge restarts the clock with
+# a tick (or, with offset, schedules the first tick offset samples later),
+# ticks are inserted every period samples and a tick placed no more than
+# margin samples before a rising edge is removed as an early one
+class MFMDataCleanup(ClockRecovery):
+
+    # --------------------------------------------------------------------
+    def __regen(self, s):
+        clock = []
+        ov = 1
+        next_clock = 0
+
+        for (counter, v) in enumerate(s.tolist()):
+            if (ov == 0) and (v == 1):
+                if self.margin and not self.offset:
+                    if clock and counter - clock[-1] <= self.margin:
+                        clock.pop()
+                if not self.offset:
+                    next_clock = counter + self.period
+                    clock.append(counter)
+                else:
+                    next_clock = counter + self.offset
+
+            if counter >= next_clock:
+                clock.append(counter)
+                next_clock = counter + self.period
+
+            ov = v
+
+        return np.array(clock, dtype=np.int64)
+
+    # --------------------------------------------------------------------
+    def recover(self):
+        s = self.sample_array()
+
+        if self.period < 1:
+            clock = self.__regen(s)
+        else:
+            p = self.period
+            edges = self.rising_edges(s)
+
+            # segments start at 0 and on each edge, first tick in a segment
+            # is delayed by offset (only if positive)
+            first = np.concatenate(([0], edges + max(self.offset, 0)))
+            bound = np.concatenate((edges, [len(s)]))
+            count = np.maximum((bound - first - 1) // p + 1, 0)
+            seg = np.repeat(np.arange(len(first)), count)
+            idx = np.arange(len(seg)) - np.repeat(np.cumsum(count) - count, count)
+            clock = first[seg] + idx * p
+
+            # early clock cleanup: drop last tick of a segment if it's
+            # too close to the edge that starts the next one
+            if self.margin and not self.offset and len(edges):
+                last = np.cumsum(count)[:-1] - 1
+                early = (edges - clock[last]) <= self.margin
+                keep = np.ones(len(clock), dtype=bool)
+                keep[last[early]] = False
+                clock = clock[keep]
+
+        if not len(s):
+            return np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.int64)
+
+        return s[clock], clock
+
+
+# ------------------------------------------------------------------------
+# Digital PLL: each rising edge is placed in the nearest half-bit cell
+# and the phase error adjusts both the cell phase and the cell period,
+# so the clock follows spindle speed drift. Period can drift by up to
+# margin samples, cells are reported offset samples later.
+class MFMDataPLL(ClockRecovery):
+
+    PHASE_GAIN = 0.7
+    FREQ_GAIN = 0.02
+
+    # --------------------------------------------------------------------
+    def recover(self):
+        (edges, length) = self.edge_array()
+        edges = edges.tolist()
+
+        if not edges:
+            return np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.int64)
+
+        period = float(self.period)
+        lo = max(1.0, period - abs(self.margin))
+        hi = max(lo, period + abs(self.margin))
+
+        # each edge ends a run of n cells starting after the reference point
+        refs = [edges[0] - period]
+        periods = [period]
+        counts = [1]
+        ref = float(edges[0])
+        for e in edges[1:]:
+            gap = e - ref
+            n = max(1, int(gap / period + 0.5))
+            err = gap - n * period
+            refs.append(ref)
+            periods.append(period)
+            counts.append(n)
+            ref += n * period + self.PHASE_GAIN * err
+            period = min(hi, max(lo, period + self.FREQ_GAIN * err / n))
+
+        # empty cells after the last edge
+        tail = int((length - 1 - ref) / period)
+        if tail > 0:
+            refs.append(ref)
+            periods.append(period)
+            counts.append(tail)
+
+        counts = np.array(counts, dtype=np.int64)
+        seg = np.repeat(np.arange(len(counts)), counts)
+        idx = np.arange(len(seg)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+        positions = np.rint(np.array(refs)[seg] + idx * np.array(periods)[seg]).astype(np.int64)
+
+        # edge is in the last cell of each run (except for the tail)
+        values = np.zeros(len(seg), dtype=np.uint8)
+        values[np.cumsum(counts[:len(edges)]) - 1] = 1
+
+        return values, positions + self.offset
+
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
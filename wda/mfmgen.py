@@ -0,0 +1,162 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+import random
+import numpy as np
+from sector import *
+
+GAP_BYTE = 0x4e
+DATA_MARKER = 0xf8
+CYLS_MSB = {0: 0xfe, 256: 0xff, 512: 0xfc, 768: 0xfd}
+
+
+# ------------------------------------------------------------------------
+def encode_bytes(data, last_bit):
+    # MFM: clock is 1 only between two 0 data bits
+    cells = []
+    for byte in data:
+        for bit in range(7, -1, -1):
+            d = (byte >> bit) & 1
+            c = 1 if (d == 0 and last_bit == 0) else 0
+            cells += [c, d]
+            last_bit = d
+    return cells, last_bit
+
+
+# ------------------------------------------------------------------------
+# Gap and sync lengths (in bytes) that fit given sector format's layout:
+# gap covers the skipped part and half of SYNC deadline, sync is long
+# enough for SYNC pattern plus up to half of A1 deadline
+def layout_sizes(layout):
+    sizes = []
+    for (i, phase) in enumerate(layout):
+        if isinstance(phase, BitSeqFinder) and phase.hbit_seq == MFMSector.SYNC:
+            # for the first phase, previous one is the gap at the end of the layout
+            prev = layout[i-1] if i else layout[-2]
+            skip = prev.hbit_count if isinstance(prev, Skipper) else 0
+            gap = -(-skip // 16) + (phase.deadline // 2) // 16
+            sync = len(MFMSector.SYNC) // 16 + (layout[i+1].deadline // 2) // 16
+            sizes.append((gap, sync))
+    return sizes
+
+
+# ------------------------------------------------------------------------
+# Half-bit cells of a whole track (one revolution) in given sector format.
+# Returns cells and data payload of each sector.
+def track_cells(sector_class, cylinder, head, sectors, seed=0, bad_sectors=()):
+    rnd = random.Random(seed)
+    fmt = sector_class()
+    ((head_gap, head_sync), (data_gap, data_sync)) = layout_sizes(fmt.layout)
+    # data field is the longest one
+    data_size = max([p.byte_count for p in fmt.layout if isinstance(p, ByteReader)])
+    head_crc_len = fmt.head_crc_alg.Width // 8
+    data_crc_len = fmt.data_crc_alg.Width // 8
+
+    cells = []
+    payloads = {}
+    last_bit = 0
+
+    def field(data, last_bit):
+        (c, last_bit) = encode_bytes(data, last_bit)
+        cells.extend(c)
+        return last_bit
+
+    def mark(data_bytes, crc_alg, crc_len):
+        crc = crc_alg.table_crc([0xa1] + data_bytes)
+        cells.extend(MFMSector.A1)
+        return field(data_bytes + list(crc.to_bytes(crc_len, "big")), 1)
+
+    # start of the track is a short gap
+    last_bit = field([GAP_BYTE] * 4, last_bit)
+
+    for s in range(0, sectors):
+        flags = 0b00100000 | (head & 0b111)
+        if s in bad_sectors:
+            flags |= 0b10000000
+        header = [CYLS_MSB[cylinder & 0x300], cylinder & 0xff, flags, s]
+
+        if s:
+            last_bit = field([GAP_BYTE] * head_gap, last_bit)
+        last_bit = field([0] * head_sync, last_bit)
+        last_bit = mark(header, fmt.head_crc_alg, head_crc_len)
+
+        last_bit = field([GAP_BYTE] * data_gap, last_bit)
+        last_bit = field([0] * data_sync, last_bit)
+        payloads[s] = [rnd.randrange(256) for x in range(0, data_size)]
+        last_bit = mark([DATA_MARKER] + payloads[s], fmt.data_crc_alg, data_crc_len)
+
+    # gap after the last sector has to fit Skipper at the end of the layout
+    last_bit = field([GAP_BYTE] * head_gap, last_bit)
+
+    return cells, payloads
+
+
+# ------------------------------------------------------------------------
+def inject_errors(cells, count, seed=0):
+    rnd = random.Random(seed)
+    cells = list(cells)
+    for i in range(0, count):
+        pos = rnd.randrange(len(cells))
+        cells[pos] ^= 1
+    return cells
+
+
+# ------------------------------------------------------------------------
+# Turn cells into samples: each 1 cell is a flux transition (a pulse
+# pulse_width samples long). Cell period is in samples and may vary
+# with sinusoidal speed drift (relative amplitude, one cycle per track),
+# transition timing gets uniform jitter of +/- jitter samples.
+def cells_to_samples(cells, period=10.0, jitter=0.0, drift=0.0, pulse_width=2, seed=0):
+    rng = np.random.default_rng(seed)
+    cells = np.asarray(cells, dtype=np.uint8)
+    n = len(cells)
+
+    phase = 2 * np.pi * np.arange(n) / max(n, 1)
+    cell_len = period * (1 + drift * np.sin(phase))
+    start = np.concatenate(([0.0], np.cumsum(cell_len)[:-1]))
+    length = int(np.ceil(start[-1] + cell_len[-1])) + pulse_width if n else 0
+
+    edges = start[cells == 1]
+    if jitter:
+        edges = edges + rng.uniform(-jitter, jitter, len(edges))
+    edges = np.clip(np.rint(edges).astype(np.int64), 1, max(length - pulse_width, 1))
+
+    samples = np.zeros(length, dtype=np.uint8)
+    for w in range(0, pulse_width):
+        samples[edges + w] = 1
+    return samples
+
+
+# ------------------------------------------------------------------------
+def write_wds(file_name, samples):
+    with open(file_name, "wb") as f:
+        f.write(np.packbits(samples).tobytes())
+
+
+# ------------------------------------------------------------------------
+# Write a synthetic track file, returns sector payloads
+def write_track(file_name, sector_class, cylinder, head, sectors, period=10.0, jitter=0.0, drift=0.0, errors=0, revolutions=2, seed=0):
+    (cells, payloads) = track_cells(sector_class, cylinder, head, sectors, seed)
+    track = []
+    for r in range(0, revolutions):
+        track += inject_errors(cells, errors, seed + r)
+    write_wds(file_name, cells_to_samples(track, period, jitter, drift, seed=seed))
+    return payloads
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
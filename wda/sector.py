@@ -15,7 +15,10 @@
 #  Foundation, Inc.,
 #  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import time
+import numpy as np
 import crc_algorithms
+from events import *
 
 # ------------------------------------------------------------------------
 class State:
@@ -36,6 +39,12 @@ class Looper:
     def feed(self, s):
         return State.LOOP_END
 
+    # -------------------------------------------------------------------
+    def scan(self, cells, i):
+        if i < len(cells):
+            return State.LOOP_END, i + 1
+        return State.COOKING, i
+
     # -------------------------------------------------------------------
     def last(self, bit):
         pass
@@ -60,6 +69,16 @@ class Skipper:
         else:
             return State.COOKING
 
+    # -------------------------------------------------------------------
+    def scan(self, cells, i):
+        end = i + max(self.hbit_count - self.counter, 1)
+        if end <= len(cells):
+            self.counter = 0
+            return State.DONE, end
+        else:
+            self.counter += len(cells) - i
+            return State.COOKING, len(cells)
+
     # -------------------------------------------------------------------
     def last(self, bit):
         pass
@@ -75,36 +94,62 @@ class BitSeqFinder:
         self.deadline = deadline
         self.callback = callback
 
-        self.hbit_buf = []
+        # sequence as an integer (first half-bit is the MSB) for the shift register
+        self.seq_len = len(hbit_seq)
+        self.seq_mask = (1 << self.seq_len) - 1
+        self.seq_reg = 0
+        for v in hbit_seq:
+            self.seq_reg = (self.seq_reg << 1) | v
+        # ...and as bytes for bulk search in cell buffers
+        self.seq_raw = bytes(hbit_seq)
+
+        self.hbit_reg = 0
         self.clock_tick = 0
+        self.consumed = 0
+        self.events = None
 
     # --------------------------------------------------------------------
     def feed(self, s):
         (t, v) = s
-        self.hbit_buf.append(v)
 
         # past the deadline
-        if self.clock_tick > (self.deadline + len(self.hbit_seq)):
-            self.hbit_buf = []
+        if self.clock_tick > (self.deadline + self.seq_len):
+            self.hbit_reg = 0
             self.clock_tick = 0
-            print(" * Could not find bit sequence within given deadline")
+            if self.events is not None:
+                self.events.add(Events.DEADLINE, t, self.name)
             return State.FAILED
 
-        # buffer full
-        elif len(self.hbit_buf) == len(self.hbit_seq):
-            # does it match?
-            if self.hbit_buf == self.hbit_seq:
-                self.hbit_buf = []
-                self.clock_tick = 0
-                self.callback(self.hbit_buf)
-                return State.DONE
-            else:
-                self.hbit_buf.pop(0)
-
+        self.hbit_reg = ((self.hbit_reg << 1) | v) & self.seq_mask
         self.clock_tick += 1
 
+        # enough bits shifted in and they match?
+        if (self.clock_tick >= self.seq_len) and (self.hbit_reg == self.seq_reg):
+            self.consumed = self.clock_tick
+            self.hbit_reg = 0
+            self.clock_tick = 0
+            self.callback([])
+            return State.DONE
+
         return State.COOKING
 
+    # --------------------------------------------------------------------
+    def scan(self, cells, i):
+        # sequence has to end within deadline + sequence length cells
+        limit = i + self.deadline + self.seq_len + 1
+        pos = cells.raw.find(self.seq_raw, i, limit)
+
+        if pos >= 0:
+            self.consumed = pos + self.seq_len - i
+            self.callback([])
+            return State.DONE, pos + self.seq_len
+        elif limit < len(cells):
+            if self.events is not None:
+                self.events.add(Events.DEADLINE, int(cells.positions[limit]), self.name)
+            return State.FAILED, limit + 1
+        else:
+            return State.COOKING, len(cells)
+
     # -------------------------------------------------------------------
     def last(self, bit):
         pass
@@ -113,6 +158,9 @@ class BitSeqFinder:
 # ------------------------------------------------------------------------
 class ByteReader:
 
+    VIOLATION_SHIFTS = np.array([8 + 2*(7-x) for x in range(0, 8)])
+    TABLE = None
+
     # --------------------------------------------------------------------
     def __init__(self, name, byte_count, callback):
         self.name = name
@@ -124,6 +172,7 @@ class ByteReader:
         self.bit_odd = 1
         self.last_bit = -1
         self.clock = 0
+        self.events = None
 
     # --------------------------------------------------------------------
     def feed(self, s):
@@ -138,13 +187,14 @@ class ByteReader:
         self.bit_odd = 1
 
         # check for illegal MFM bits
-        if (v == 1) and (self.clock == 1):
-            print(" * MFM illegal cell: 11 at sample: {}".format(t))
-        elif v == 0:
-            if (self.clock == 0) and (self.last_bit == 0):
-                print(" * MFM illegal cell: 00 after 0 at sample: {}".format(t))
-            elif (self.clock == 1) and (self.last_bit == 1):
-                print(" * MFM illegal cell: 10 after 1 at sample: {}".format(t))
+        if self.events is not None:
+            if (v == 1) and (self.clock == 1):
+                self.events.add(Events.ILLEGAL_11, t, self.name)
+            elif v == 0:
+                if (self.clock == 0) and (self.last_bit == 0):
+                    self.events.add(Events.ILLEGAL_00, t, self.name)
+                elif (self.clock == 1) and (self.last_bit == 1):
+                    self.events.add(Events.ILLEGAL_10, t, self.name)
 
         # shift in even bits (data)
         self.bytes[self.byte_pos] |= (v << self.bit_pos)
@@ -167,6 +217,80 @@ class ByteReader:
                 self.bytes.append(0)
                 return State.COOKING
 
+    # -------------------------------------------------------------------
+    def scan(self, cells, i):
+        end = i + 16 * self.byte_count
+
+        # not enough cells for the whole field, go the slow way
+        if end > len(cells):
+            values = cells.values_list()
+            positions = cells.positions_list()
+            while i < len(values):
+                self.feed((positions[i], values[i]))
+                i += 1
+            return State.COOKING, i
+
+        (data, viol_pos, viol_kind) = self.decode(cells.values, i)
+        if len(viol_pos) and self.events is not None:
+            self.events.add_many(viol_kind, cells.positions[viol_pos], self.name)
+
+        self.last_bit = data[-1] & 1
+        self.callback(data)
+        return State.DONE, end
+
+    # -------------------------------------------------------------------
+    def decode(self, values, i):
+        n = self.byte_count
+        cells = values[i:i + 16*n].reshape(n, 16)
+
+        # 16 cells (clock, data, clock, data, ...) of each byte as a word
+        packed = np.packbits(cells, axis=1).astype(np.int64)
+        words = (packed[:, 0] << 8) | packed[:, 1]
+
+        # data bit preceding each byte: last_bit for the first one, then
+        # the last data cell of the previous byte
+        prev = np.empty(n, dtype=np.int64)
+        prev[0] = self.last_bit if self.last_bit in (0, 1) else 2
+        prev[1:] = cells[:-1, 15]
+
+        entries = ByteReader.table()[(prev << 16) | words]
+        data = (entries & 0xff).tolist()
+
+        # violation kinds for each data bit, MSB first
+        kinds = (entries[:, None] >> ByteReader.VIOLATION_SHIFTS) & 3
+        (byte_idx, bit_idx) = np.nonzero(kinds)
+        viol_pos = i + 16*byte_idx + 2*bit_idx + 1
+
+        return data, viol_pos, kinds[byte_idx, bit_idx]
+
+    # -------------------------------------------------------------------
+    @staticmethod
+    def table():
+        if ByteReader.TABLE is None:
+            ByteReader.TABLE = ByteReader.gen_table()
+        return ByteReader.TABLE
+
+    # -------------------------------------------------------------------
+    @staticmethod
+    def gen_table():
+        # index: previous data bit (0, 1 or 2 for unknown) << 16 | 16 cells
+        # value: decoded byte | 2-bit violation kind for each data bit << 8
+        words = np.tile(np.arange(0x10000, dtype=np.int64), 3)
+        prev = np.repeat(np.arange(3, dtype=np.int64), 0x10000)
+        byte = np.zeros_like(words)
+        kinds = np.zeros_like(words)
+        for bit in range(0, 8):
+            c = (words >> (15 - 2*bit)) & 1
+            d = (words >> (14 - 2*bit)) & 1
+            kind = np.where(
+                (c == 1) & (d == 1), 1, np.where(
+                (c == 0) & (d == 0) & (prev == 0), 2, np.where(
+                (c == 1) & (d == 0) & (prev == 1), 3, 0)))
+            byte = (byte << 1) | d
+            kinds = (kinds << 2) | kind
+            prev = d
+        return byte | (kinds << 8)
+
     # -------------------------------------------------------------------
     def last(self, bit):
         self.last_bit = bit
@@ -178,15 +302,20 @@ class MFMSector:
     A1 = [0, 1, 0, 0, 0, 1, 0, 0, 1, 0, 0, 0, 1, 0, 0, 1]
     SYNC = [1, 0] * (10*8)
 
+    # fields are located by the last cell of their A1 mark
+    FIELDS = {"Head A1": "header", "Data A1": "data"}
+
     # --------------------------------------------------------------------
     def __init__(self, sector_size):
         self.sector_size = sector_size
 
         self.last_bit = 0
-        self.crc_head_buf = []
-        self.crc_data_buf = []
+        self.crc_head = 0
+        self.crc_data = 0
         self.crc16_alg = None
         self.crc32_alg = None
+        self.head_crc_alg = None
+        self.data_crc_alg = None
         self.cylinder = 0
         self.head = 0
         self.sector = 0
@@ -196,42 +325,54 @@ class MFMSector:
         self.head_crc_ok = False
         self.data_crc_ok = False
 
+        self.marker = 0
+        self.data_crc_read = 0
         self.data = []
 
         self.phase = 0
         self.layout = []
+        self.stats = None
+        self.events = None
+        self.marks = {}
+        self.phase_time = 0.0
+        self.phase_cells = 0
+        self.phase_crc = 0.0
 
     # --------------------------------------------------------------------
     def callback_head_a1(self, arg):
-        self.crc_head_buf = [0xa1]
+        self.crc_head = self.crc_update(self.head_crc_alg, self.head_crc_alg.init(), [0xa1])
         self.last_bit = 1
 
     # --------------------------------------------------------------------
     def callback_head_data(self, arg):
-        self.crc_head_buf += arg
+        self.crc_head = self.crc_update(self.head_crc_alg, self.crc_head, arg)
         self.last_bit = arg[len(arg)-1] & 1
 
         cyls_msb = {0xfe: 0, 0xff: 256, 0xfc: 512, 0xfd: 768}
-        self.cylinder = cyls_msb[arg[0]] + arg[1]
+        # unknown MSB marker means broken header, header CRC will tell
+        self.cylinder = cyls_msb.get(arg[0], 0) + arg[1]
         self.head = arg[2] & 0b00000111
         self.sector_size = arg[2] & 0b01100000
         if arg[2] & 0b10000000:
             self.bad = True
         self.sector = arg[3]
+        if self.events is not None:
+            self.events.sector = self.sector
 
     # --------------------------------------------------------------------
     def callback_data_a1(self, arg):
-        self.crc_data_buf = [0xa1]
+        self.crc_data = self.crc_update(self.data_crc_alg, self.data_crc_alg.init(), [0xa1])
         self.last_bit = 1
 
     # --------------------------------------------------------------------
     def callback_data_marker(self, arg):
-        self.crc_data_buf += arg
+        self.crc_data = self.crc_update(self.data_crc_alg, self.crc_data, arg)
         self.last_bit = arg[len(arg)-1] & 1
+        self.marker = arg[0]
 
     # --------------------------------------------------------------------
     def callback_data_data(self, arg):
-        self.crc_data_buf += arg
+        self.crc_data = self.crc_update(self.data_crc_alg, self.crc_data, arg)
         self.last_bit = arg[len(arg)-1] & 1
         self.data = arg
 
@@ -239,6 +380,32 @@ class MFMSector:
     def callback_none(self, arg):
         pass
 
+    # --------------------------------------------------------------------
+    def set_events(self, events):
+        self.events = events
+        for phase in self.layout:
+            phase.events = events
+
+    # --------------------------------------------------------------------
+    # Remember where a field was found (cell index and sample position),
+    # called whenever a phase is done
+    def mark(self, phase, cell, position):
+        field = MFMSector.FIELDS.get(phase.name)
+        if field:
+            self.marks[field] = (cell, position)
+
+    # --------------------------------------------------------------------
+    def crc_update(self, alg, register, data):
+        if self.stats:
+            with self.stats.timer("crc"):
+                return alg.update(register, data)
+        return alg.update(register, data)
+
+    # --------------------------------------------------------------------
+    def data_crc(self, data):
+        crc = self.data_crc_alg.update(self.data_crc_alg.init(), [0xa1, self.marker])
+        return self.data_crc_alg.final(self.data_crc_alg.update(crc, data))
+
     # --------------------------------------------------------------------
     def feed(self, s):
         result = self.layout[self.phase].feed(s)
@@ -249,13 +416,14 @@ class MFMSector:
 
         # Phase is done, but we're still cooking
         elif result == State.DONE:
+            if self.stats and isinstance(self.layout[self.phase], BitSeqFinder):
+                self.stats.finder(self.layout[self.phase].name, self.layout[self.phase].consumed)
             self.phase += 1
             self.layout[self.phase].last(self.last_bit)
             return State.COOKING
 
         # Phase failed, cooking failed
         elif result == State.FAILED:
-            print(" * Failed at: {}".format(self.layout[self.phase].name))
             self.phase = 0
             return State.FAILED
 
@@ -264,6 +432,61 @@ class MFMSector:
             phase = 0
             return State.DONE
 
+    # --------------------------------------------------------------------
+    def scan(self, cells, i):
+        while True:
+            phase = self.layout[self.phase]
+            if self.stats:
+                (result, i) = self.timed_scan(phase, cells, i)
+            else:
+                (result, i) = phase.scan(cells, i)
+
+            # Phase is done, go on with the next one
+            if result == State.DONE:
+                if self.stats and isinstance(phase, BitSeqFinder):
+                    self.stats.finder(phase.name, phase.consumed)
+                self.mark(phase, i - 1, int(cells.positions[i - 1]))
+                self.phase += 1
+                self.layout[self.phase].last(self.last_bit)
+
+            # Phase failed, cooking failed
+            elif result == State.FAILED:
+                self.phase = 0
+                return State.FAILED, i
+
+            # Last phase done, return success!
+            elif result == State.LOOP_END:
+                return State.DONE, i
+
+            # Out of cells, still cooking
+            else:
+                return State.COOKING, i
+
+    # --------------------------------------------------------------------
+    def timed_scan(self, phase, cells, i):
+        crc_t = self.stats.times.get("crc", 0.0)
+        start = time.perf_counter()
+        (result, j) = phase.scan(cells, i)
+        t = time.perf_counter() - start
+        self.stats.phase(phase, t, self.stats.times.get("crc", 0.0) - crc_t, j - i)
+        return result, j
+
+    # --------------------------------------------------------------------
+    # feed() with time and cells of each phase collected into stats,
+    # just like timed_scan() does for bulk scans
+    def timed_feed(self, s):
+        phase = self.layout[self.phase]
+        if not self.phase_cells:
+            self.phase_crc = self.stats.times.get("crc", 0.0)
+        start = time.perf_counter()
+        result = self.feed(s)
+        self.phase_time += time.perf_counter() - start
+        self.phase_cells += 1
+        if result is not None:
+            self.stats.phase(phase, self.phase_time, self.stats.times.get("crc", 0.0) - self.phase_crc, self.phase_cells)
+            (self.phase_time, self.phase_cells) = (0.0, 0)
+        return result
+
     # --------------------------------------------------------------------
     def __len__(self):
         return len(self.data)
@@ -281,8 +504,10 @@ class SectorWD(MFMSector):
     def __init__(self):
         sector_size = 512
         super(SectorWD, self).__init__(sector_size)
-        self.crc16_alg = crc_algorithms.Crc(width = 16, poly = 0x1021, reflect_in = False, xor_in = 0xffff, reflect_out = False, xor_out = 0x0000);
-        self.crc32_alg = crc_algorithms.Crc(width = 32, poly = 0x140a0445, reflect_in = False, xor_in = 0xffffffff, reflect_out = False, xor_out = 0x0000);
+        self.crc16_alg = crc_algorithms.TableCrc(width = 16, poly = 0x1021, reflect_in = False, xor_in = 0xffff, reflect_out = False, xor_out = 0x0000);
+        self.crc32_alg = crc_algorithms.TableCrc(width = 32, poly = 0x140a0445, reflect_in = False, xor_in = 0xffffffff, reflect_out = False, xor_out = 0x0000);
+        self.head_crc_alg = self.crc16_alg
+        self.data_crc_alg = self.crc32_alg
         self.layout = [
             BitSeqFinder("Head SYNC", MFMSector.SYNC, 18*8*2, self.callback_none),
             BitSeqFinder("Head A1", MFMSector.A1, 3*8*2, self.callback_head_a1),
@@ -301,14 +526,15 @@ class SectorWD(MFMSector):
    # --------------------------------------------------------------------
     def callback_head_crc(self, arg):
         crc_read = arg[0]*256 + arg[1]
-        crc_computed = self.crc16_alg.bit_by_bit_fast(''.join([chr(x) for x in self.crc_head_buf]))
+        crc_computed = self.head_crc_alg.final(self.crc_head)
         if crc_read == crc_computed:
             self.head_crc_ok = True
 
     # --------------------------------------------------------------------
     def callback_data_crc(self, arg):
         crc_read = arg[0]*16777216 + arg[1]*65536 + arg[2]*256 + arg[3]
-        crc_computed = self.crc32_alg.bit_by_bit_fast(''.join([chr(x) for x in self.crc_data_buf]))
+        crc_computed = self.data_crc_alg.final(self.crc_data)
+        self.data_crc_read = crc_read
         if crc_read == crc_computed:
             self.data_crc_ok = True
 
@@ -322,7 +548,9 @@ class SectorAmepol(MFMSector):
         sector_size = 512
         super(SectorAmepol, self).__init__(sector_size)
 
-        self.crc16_alg = crc_algorithms.Crc(width = 16, poly = 0x1021, reflect_in = False, xor_in = 0xffff, reflect_out = False, xor_out = 0x0000);
+        self.crc16_alg = crc_algorithms.TableCrc(width = 16, poly = 0x1021, reflect_in = False, xor_in = 0xffff, reflect_out = False, xor_out = 0x0000);
+        self.head_crc_alg = self.crc16_alg
+        self.data_crc_alg = self.crc16_alg
 
         self.layout = [
             BitSeqFinder("Head SYNC", MFMSector.SYNC, 750, self.callback_none),
@@ -342,14 +570,15 @@ class SectorAmepol(MFMSector):
     # --------------------------------------------------------------------
     def callback_head_crc(self, arg):
         crc_read = arg[0]*256 + arg[1]
-        crc_computed = self.crc16_alg.bit_by_bit_fast(''.join([chr(x) for x in self.crc_head_buf]))
+        crc_computed = self.head_crc_alg.final(self.crc_head)
         if crc_read == crc_computed:
             self.head_crc_ok = True
 
     # --------------------------------------------------------------------
     def callback_data_crc(self, arg):
         crc_read = arg[0]*256 + arg[1]
-        crc_computed = self.crc16_alg.bit_by_bit_fast(''.join([chr(x) for x in self.crc_data_buf]))
+        crc_computed = self.data_crc_alg.final(self.crc_data)
+        self.data_crc_read = crc_read
         if crc_read == crc_computed:
             self.data_crc_ok = True
 
@@ -363,8 +592,10 @@ class SectorComputex(MFMSector):
         sector_size = 512
         super(SectorComputex, self).__init__(sector_size)
 
-        self.crc16_alg = crc_algorithms.Crc(width = 16, poly = 0x1021, reflect_in = False, xor_in = 0xffff, reflect_out = False, xor_out = 0x0000);
-        self.crc32_alg = crc_algorithms.Crc(width = 32, poly = 0x140a0445, reflect_in = False, xor_in = 0xffffffff, reflect_out = False, xor_out = 0x0000);
+        self.crc16_alg = crc_algorithms.TableCrc(width = 16, poly = 0x1021, reflect_in = False, xor_in = 0xffff, reflect_out = False, xor_out = 0x0000);
+        self.crc32_alg = crc_algorithms.TableCrc(width = 32, poly = 0x140a0445, reflect_in = False, xor_in = 0xffffffff, reflect_out = False, xor_out = 0x0000);
+        self.head_crc_alg = self.crc16_alg
+        self.data_crc_alg = self.crc32_alg
 
         self.layout = [
             BitSeqFinder("Head SYNC", MFMSector.SYNC, 750, self.callback_none),
@@ -384,13 +615,23 @@ class SectorComputex(MFMSector):
     # --------------------------------------------------------------------
     def callback_head_crc(self, arg):
         crc_read = arg[0]*256 + arg[1]
-        crc_computed = self.crc16_alg.bit_by_bit_fast(''.join([chr(x) for x in self.crc_head_buf]))
+        crc_computed = self.head_crc_alg.final(self.crc_head)
         if crc_read == crc_computed:
             self.head_crc_ok = True
 
     # --------------------------------------------------------------------
     def callback_data_crc(self, arg):
         crc_read = arg[0]*16777216 + arg[1]*65536 + arg[2]*256 + arg[3]
-        crc_computed = self.crc32_alg.bit_by_bit_fast(''.join([chr(x) for x in self.crc_data_buf]))
+        crc_computed = self.data_crc_alg.final(self.crc_data)
+        self.data_crc_read = crc_read
         if crc_read == crc_computed:
             self.data_crc_ok = True
+
+
+# --------------------------------------------------------------------
+# All known sector formats, by name
+SECTOR_FORMATS = {
+    "SectorWD": SectorWD,
+    "SectorAmepol": SectorAmepol,
+    "SectorComputex": SectorComputex,
+}
@@ -0,0 +1,145 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+import json
+import time
+import itertools
+import contextlib
+
+
+# ------------------------------------------------------------------------
+# Decoding statistics: wall time and sample/cell/byte counts per stage,
+# cells consumed by each sequence finder before it matched, and per-sector
+# timings. Decoding code gets None instead of a Stats object when
+# statistics are disabled, and checks for it only outside per-cell loops.
+class Stats:
+
+    STAGES = {"BitSeqFinder": "sync_search", "ByteReader": "byte_decode"}
+
+    # --------------------------------------------------------------------
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self.finders = {}
+        self.sectors = []
+        self.info = {}
+
+    # --------------------------------------------------------------------
+    def add_time(self, name, t):
+        self.times[name] = self.times.get(name, 0.0) + t
+
+    # --------------------------------------------------------------------
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    # --------------------------------------------------------------------
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    # --------------------------------------------------------------------
+    # Called once a sector layout phase is done processing cells.
+    # CRC time spent in phase callbacks is accounted separately.
+    def phase(self, phase, t, crc_t, cells):
+        stage = Stats.STAGES.get(type(phase).__name__)
+        if stage:
+            self.add_time(stage, t - crc_t)
+            self.count(stage + "_cells", cells)
+            if stage == "byte_decode":
+                self.count("bytes", cells // 16)
+
+    # --------------------------------------------------------------------
+    def finder(self, name, cells):
+        self.finders.setdefault(name, []).append(cells)
+
+    # --------------------------------------------------------------------
+    def sector(self, done, sector, t, start, end):
+        self.sectors.append({
+            "sector": sector.sector,
+            "result": "DONE" if done else "FAILED",
+            "head_crc": sector.head_crc_ok,
+            "data_crc": sector.data_crc_ok,
+            "time": t,
+            "start": start,
+            "end": end,
+        })
+
+    # --------------------------------------------------------------------
+    def as_dict(self):
+        return {
+            **self.info,
+            "times": self.times,
+            "counts": self.counts,
+            "finders": self.finders,
+            "sectors": self.sectors,
+        }
+
+    # --------------------------------------------------------------------
+    def save(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+
+# ------------------------------------------------------------------------
+# Sample source that adds time spent producing samples to "unpack" stat,
+# so unpacking is timed on the same path a normal decode takes (it's then
+# also a part of "clock_recovery" time). Samples iterated one by one are
+# taken from the source in timed batches.
+class TimedSamples:
+
+    BATCH = 64*1024
+
+    # --------------------------------------------------------------------
+    def __init__(self, samples, stats):
+        self.samples = samples
+        self.stats = stats
+
+    # --------------------------------------------------------------------
+    def __getattr__(self, name):
+        return getattr(self.samples, name)
+
+    # --------------------------------------------------------------------
+    def __len__(self):
+        return len(self.samples)
+
+    # --------------------------------------------------------------------
+    def __iter__(self):
+        samples = iter(self.samples)
+        while True:
+            with self.stats.timer("unpack"):
+                batch = list(itertools.islice(samples, TimedSamples.BATCH))
+            if not batch:
+                return
+            yield from batch
+
+    # --------------------------------------------------------------------
+    def chunks(self):
+        chunks = iter(self.samples.chunks())
+        while True:
+            with self.stats.timer("unpack"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
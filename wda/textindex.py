@@ -0,0 +1,191 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import re
+import numpy as np
+from m400lib import *
+
+
+# ------------------------------------------------------------------------
+# Text runs of at least min_len characters (mask is True for text
+# characters), joined with 0 separators. Returns the joined text, run
+# positions in text and their positions in joined text.
+def text_runs(text, mask, min_len):
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    long = (ends - starts) >= min_len
+    (starts, ends) = (starts[long], ends[long])
+
+    # each run is followed by a separator
+    delta = np.zeros(len(mask) + 1, dtype=np.int8)
+    delta[starts] = 1
+    delta[ends] = -1
+    keep = np.cumsum(delta[:-1], dtype=np.int8).astype(bool)
+    keep[ends[ends < len(keep)]] = True
+    joined = np.where(mask[keep], text[keep], 0).astype(np.uint8)
+    if len(ends) and ends[-1] == len(text):
+        joined = np.append(joined, np.uint8(0))
+
+    lengths = ends - starts + 1
+    at = np.cumsum(lengths) - lengths
+    return joined.tobytes(), starts, at
+
+
+# ------------------------------------------------------------------------
+# Searchable text of a disk image: runs of printable ASCII bytes and
+# runs of R40 words, at least min_len characters long. Each kind is kept
+# as one byte string with runs separated by 0, together with run
+# positions in the image, so a match maps back to image byte offset.
+# Index is stored in a .idx.npz file next to the image.
+class TextIndex:
+
+    VERSION = 1
+    KINDS = ["ascii", "r40"]
+
+    # --------------------------------------------------------------------
+    def __init__(self, image, min_len=4):
+        self.image = image
+        self.min_len = min_len
+        self.text = {}
+        self.starts = {}
+        self.at = {}
+        self.lower = {}
+
+    # --------------------------------------------------------------------
+    def file_name(self):
+        return self.image + ".idx.npz"
+
+    # --------------------------------------------------------------------
+    def image_id(self):
+        st = os.stat(self.image)
+        return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+    # --------------------------------------------------------------------
+    def build(self):
+        data = np.fromfile(self.image, dtype=np.uint8)
+        runs = {"ascii": text_runs(data, (data >= 32) & (data <= 126), self.min_len)}
+
+        # words over 63999 are not R40, all-space words are not text either,
+        # positions of R40 runs are in characters (3 per word)
+        w = words(data)
+        mask = np.repeat((w < 64000) & (w != 0), 3)
+        runs["r40"] = text_runs(r40_chars()[w].ravel(), mask, -(-self.min_len // 3) * 3)
+
+        for (kind, (text, starts, at)) in runs.items():
+            (self.text[kind], self.starts[kind], self.at[kind]) = (text, starts, at)
+        self.lower = {}
+
+    # --------------------------------------------------------------------
+    def save(self):
+        arrays = {}
+        for kind in TextIndex.KINDS:
+            arrays[kind] = np.frombuffer(self.text[kind], dtype=np.uint8)
+            arrays[kind + "_starts"] = self.starts[kind]
+            arrays[kind + "_at"] = self.at[kind]
+        tmp_name = self.file_name() + ".tmp"
+        with open(tmp_name, "wb") as f:
+            np.savez(f, version=TextIndex.VERSION, image=self.image_id(), min_len=self.min_len, **arrays)
+        os.replace(tmp_name, self.file_name())
+
+    # --------------------------------------------------------------------
+    # Returns False if there is no index, or it doesn't match the image
+    def load(self):
+        try:
+            with np.load(self.file_name()) as f:
+                if f["version"] != TextIndex.VERSION or f["min_len"] != self.min_len or not np.array_equal(f["image"], self.image_id()):
+                    return False
+                for kind in TextIndex.KINDS:
+                    self.text[kind] = f[kind].tobytes()
+                    self.starts[kind] = f[kind + "_starts"]
+                    self.at[kind] = f[kind + "_at"]
+        except (OSError, ValueError, KeyError):
+            return False
+        self.lower = {}
+        return True
+
+    # --------------------------------------------------------------------
+    def open(self, rebuild=False):
+        if rebuild or not self.load():
+            self.build()
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Cannot save index: {e}")
+
+    # --------------------------------------------------------------------
+    # Image byte offset of a position in joined text
+    def offset(self, kind, pos):
+        run = int(np.searchsorted(self.at[kind], pos, side="right")) - 1
+        pos = int(self.starts[kind][run]) + pos - int(self.at[kind][run])
+        return pos if kind == "ascii" else 2 * (pos // 3)
+
+    # --------------------------------------------------------------------
+    # Text run around a match, cut to width characters on each side
+    def context(self, kind, start, end, width=32):
+        text = self.text[kind]
+        first = max(text.rfind(b"\0", 0, start) + 1, start - width)
+        last = text.find(b"\0", end)
+        if last < 0:
+            last = len(text)
+        last = min(last, end + width)
+        return text[first:last].decode("ascii")
+
+    # --------------------------------------------------------------------
+    def matches(self, kind, pattern, ignore_case, regex):
+        if regex:
+            flags = re.IGNORECASE if ignore_case else 0
+            for m in re.finditer(pattern, self.text[kind], flags):
+                # runs are separate strings
+                if b"\0" not in m.group():
+                    yield m.start(), m.end()
+            return
+
+        text = self.text[kind]
+        if ignore_case:
+            if kind not in self.lower:
+                self.lower[kind] = text.lower()
+            (text, pattern) = (self.lower[kind], pattern.lower())
+        pos = text.find(pattern)
+        while pos >= 0:
+            yield pos, pos + len(pattern)
+            pos = text.find(pattern, pos + 1)
+
+    # --------------------------------------------------------------------
+    # Yields (kind, image byte offset, text around the match) for all matches.
+    # R40 has no lower case letters, so R40 search always ignores case.
+    def search(self, pattern, kinds=KINDS, ignore_case=False, regex=False):
+        pattern = pattern.encode("ascii")
+        for kind in kinds:
+            if kind == "r40" and not regex:
+                matches = self.matches(kind, pattern.upper(), False, False)
+            else:
+                matches = self.matches(kind, pattern, ignore_case or kind == "r40", regex)
+            for (start, end) in matches:
+                yield kind, self.offset(kind, start), self.context(kind, start, end)
+
+    # --------------------------------------------------------------------
+    # Yields (kind, image byte offset, text) for all text runs
+    def strings(self, kinds=KINDS):
+        for kind in kinds:
+            runs = [r for r in self.text[kind].split(b"\0") if r]
+            for (pos, run) in zip(self.at[kind].tolist(), runs):
+                yield kind, self.offset(kind, pos), run.decode("ascii")
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
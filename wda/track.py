@@ -15,48 +15,237 @@
 #  Foundation, Inc.,
 #  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import sys
+import copy
+import time
+import numpy as np
 from mfm import *
 from sector import *
 
+# ------------------------------------------------------------------------
+# Bitwise majority vote over sector copies (data + CRC), ties go to the
+# first copy. Returns data with CRC read and computed for it.
+def vote(copies):
+    crc_len = copies[0].data_crc_alg.Width // 8
+    raw = np.array([
+        list(s.data) + list(s.data_crc_read.to_bytes(crc_len, "big"))
+        for s in copies
+    ], dtype=np.uint8)
+    bits = np.unpackbits(raw, axis=1)
+    ones = 2 * bits.sum(axis=0, dtype=np.int64)
+    voted = np.where(ones == len(copies), bits[0], ones > len(copies)).astype(np.uint8)
+    voted = np.packbits(voted).tolist()
+
+    data = voted[:-crc_len]
+    crc_read = int.from_bytes(bytes(voted[-crc_len:]), "big")
+    return data, crc_read, copies[0].data_crc(data)
+
+
 # ------------------------------------------------------------------------
 class Track:
 
     # --------------------------------------------------------------------
-    def __init__(self, mfm_data, sector_class, sectors_per_track, verbosity=0):
-        self.data = mfm_data
+    def __init__(self, mfm_data, sector_class, sectors_per_track, verbosity=0, merge=False, stats=None, event_cap=1000):
+        self.captures = [mfm_data]
         self.sector_class = sector_class
         self.sectors_per_track = sectors_per_track
         self.sectors = {}
+        self.copies = {}
         self.verbosity = verbosity
+        self.merge = merge
+        self.stats = stats
+        self.events = Events(event_cap)
+        self.locations = []
 
     # --------------------------------------------------------------------
-    def analyze(self):
+    def add_capture(self, mfm_data):
+        self.captures.append(mfm_data)
+
+    # --------------------------------------------------------------------
+    def new_sector(self):
         sector = self.sector_class()
+        if self.merge:
+            # find the next sector anywhere, not just right after the previous one
+            sector.layout[0].deadline = sys.maxsize
+        sector.stats = self.stats
+        sector.set_events(self.events)
+        self.events.sector = None
+        return sector
+
+    # --------------------------------------------------------------------
+    def fed_sectors(self, data):
+        if self.stats:
+            data = self.timed_cells(data)
+        sector = self.new_sector()
+        (start, t) = (0, time.perf_counter())
+        for (n, s) in enumerate(data):
+            res = sector.timed_feed(s) if sector.stats else sector.feed(s)
+            if res is None:
+                continue
+            # a phase is done
+            if res == State.COOKING:
+                sector.mark(sector.layout[sector.phase - 1], n, s[0])
+                continue
+            sector.marks["end"] = (n, s[0])
+            if res == State.DONE or res == State.FAILED:
+                if self.stats:
+                    self.stats.sector(res == State.DONE, sector, time.perf_counter() - t, start, s[0])
+                    (start, t) = (s[0], time.perf_counter())
+                yield res, sector
+                sector = self.new_sector()
+
+    # --------------------------------------------------------------------
+    # Cells from per-cell clock recovery, with time spent producing them
+    # added to clock_recovery stat
+    def timed_cells(self, data):
+        (cells, n, t) = (iter(data), 0, 0.0)
+        try:
+            while True:
+                start = time.perf_counter()
+                cell = next(cells, None)
+                t += time.perf_counter() - start
+                if cell is None:
+                    return
+                n += 1
+                yield cell
+        finally:
+            self.stats.add_time("clock_recovery", t)
+            self.stats.count("cells", n)
+
+    # --------------------------------------------------------------------
+    def scanned_sectors(self, data):
+        if self.stats:
+            with self.stats.timer("clock_recovery"):
+                cells = MFMCells(*data.cells())
+            self.stats.count("cells", len(cells))
+        else:
+            cells = MFMCells(*data.cells())
+        sector = self.new_sector()
+        i = 0
+        while i < len(cells):
+            (start, t) = (i, time.perf_counter())
+            (res, i) = sector.scan(cells, i)
+            if res == State.DONE or res == State.FAILED:
+                sector.marks["end"] = (i - 1, int(cells.positions[i - 1]))
+                if self.stats:
+                    # sample positions of the last cell of previous and this sector
+                    (start, end) = (int(cells.positions[start-1]) if start else 0, int(cells.positions[i-1]))
+                    self.stats.sector(res == State.DONE, sector, time.perf_counter() - t, start, end)
+                yield res, sector
+                sector = self.new_sector()
+
+    # --------------------------------------------------------------------
+    def all_sectors(self):
+        for (capture, data) in enumerate(self.captures):
+            # process whole cell buffer if clock recovery provides one
+            if hasattr(data, "cells"):
+                sectors = self.scanned_sectors(data)
+            else:
+                sectors = self.fed_sectors(data)
+            for (res, sector) in sectors:
+                if res == State.DONE:
+                    self.locate(capture, sector)
+                yield res, sector
+
+    # --------------------------------------------------------------------
+    # Record where the sector was found: capture, revolution (copies of
+    # the sector found before in the same capture) and (cell index, sample
+    # position) of its header and data fields and its end
+    def locate(self, capture, sector):
+        revolution = sum(1 for l in self.locations if l["capture"] == capture and l["sector"] == sector.sector)
+        location = {
+            "capture": capture,
+            "cylinder": sector.cylinder,
+            "head": sector.head,
+            "sector": sector.sector,
+            "revolution": revolution,
+            "head_crc": sector.head_crc_ok,
+            "data_crc": sector.data_crc_ok,
+        }
+        for (field, (cell, position)) in sector.marks.items():
+            location[field] = [cell, position]
+        self.locations.append(location)
+
+    # --------------------------------------------------------------------
+    @staticmethod
+    def print_sector(sector, prefix=""):
+        crc_head = "OK" if sector.head_crc_ok else "FAILED"
+        crc_data = "OK" if sector.data_crc_ok else "FAILED"
+        status = "FAILED" if sector.bad else "OK"
+        print(f" * {prefix}Sector {sector.cylinder}/{sector.head}/{sector.sector:2}: CRC header: {crc_head}, CRC data: {crc_data}, status: {status}")
+
+    # --------------------------------------------------------------------
+    def analyze(self):
+        if self.merge:
+            return self.analyze_merge()
+
         ret = True
-        for s in self.data:
-            res = sector.feed(s)
+
+        for (res, sector) in self.all_sectors():
 
             if res == State.DONE:
-                crc_head = "OK" if sector.head_crc_ok else "FAILED"
-                crc_data = "OK" if sector.data_crc_ok else "FAILED"
-                status = "FAILED" if sector.bad else "OK"
                 if not sector.head_crc_ok or not sector.data_crc_ok or sector.bad:
                     ret = False
                 if not sector.head_crc_ok or not sector.data_crc_ok or sector.bad or self.verbosity > 1:
-                    print(f" * Sector {sector.cylinder}/{sector.head}/{sector.sector:2}: CRC header: {crc_head}, CRC data: {crc_data}, status: {status}")
+                    self.print_sector(sector)
 
                 self.sectors[sector.sector] = sector
                 if len(self.sectors) == self.sectors_per_track:
                     break
-                else:
-                    sector = self.sector_class()
 
             elif res == State.FAILED:
-                print(" * Cooking sector failed")
                 break
 
+        self.events.report(self.verbosity)
+        return ret
+
+    # --------------------------------------------------------------------
+    # Decode all revolutions in all captures and keep the best copy of each
+    # sector: CRC-good one if there is any, majority vote otherwise
+    def analyze_merge(self):
+        for (res, sector) in self.all_sectors():
+            if res == State.DONE:
+                if self.verbosity > 1:
+                    self.print_sector(sector, "Copy: ")
+                self.copies.setdefault(sector.sector, []).append(sector)
+
+        ret = True
+        for (num, copies) in sorted(self.copies.items()):
+            sector = self.merge_copies(copies)
+
+            if not sector.head_crc_ok or not sector.data_crc_ok or sector.bad:
+                ret = False
+            if not sector.head_crc_ok or not sector.data_crc_ok or sector.bad or self.verbosity > 1:
+                self.print_sector(sector)
+
+            self.sectors[num] = sector
+
+        self.events.report(self.verbosity)
         return ret
 
+    # --------------------------------------------------------------------
+    # Best of all copies of a sector: first one with good CRCs, or
+    # a majority vote over copies if none is good
+    def merge_copies(self, copies):
+        # sector ID can be trusted only if header CRC is OK
+        trusted = [s for s in copies if s.head_crc_ok] or copies
+        good = [s for s in trusted if s.data_crc_ok]
+
+        if good:
+            return good[0]
+        if len(trusted) < 2:
+            return trusted[0]
+
+        sector = copy.copy(trusted[0])
+        (data, crc_read, crc_computed) = vote(trusted)
+        sector.data = data
+        sector.data_crc_read = crc_read
+        sector.data_crc_ok = (crc_read == crc_computed)
+        if self.verbosity:
+            result = "OK" if sector.data_crc_ok else "FAILED"
+            print(f" * Sector {sector.cylinder}/{sector.head}/{sector.sector:2}: majority vote over {len(trusted)} copies, CRC data: {result}")
+        return sector
+
     # --------------------------------------------------------------------
     def sector(self, num):
         return self.sectors[num]
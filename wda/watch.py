@@ -0,0 +1,144 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import re
+import time
+
+# raw wds captures and their wdfconv conversions
+TRACK_FILE = re.compile(r"^(.+)--(\d{3})--(\d+)\.(?:wds|wdf)$")
+
+
+# ------------------------------------------------------------------------
+# Returns (session, cylinder, head) for a track file name, or None
+def parse_track_file(file_name):
+    m = TRACK_FILE.match(os.path.basename(file_name))
+    if not m:
+        return None
+    return m.group(1), int(m.group(2)), int(m.group(3))
+
+
+# ------------------------------------------------------------------------
+# Polls a capture directory for new track files. wds writes each track
+# with a single write() call, but that's still not atomic, so a file is
+# ready for decoding only after its size and modification time didn't
+# change for settle seconds.
+class CaptureWatcher:
+
+    # --------------------------------------------------------------------
+    def __init__(self, directory, sessions=None, settle=1.0):
+        self.directory = directory
+        self.sessions = sessions
+        self.settle = settle
+        self.seen = {}
+        self.done = {}
+
+    # --------------------------------------------------------------------
+    def wanted(self, session):
+        return not self.sessions or any(session.startswith(s) for s in self.sessions)
+
+    # --------------------------------------------------------------------
+    # Returns (session, cylinder, head, file name) for all files that
+    # became ready since the last poll, in file name order. A file that
+    # changes after it was ready becomes ready again once it settles.
+    def poll(self):
+        now = time.monotonic()
+        ready = []
+        for entry in os.scandir(self.directory):
+            track = parse_track_file(entry.name)
+            if not track or not self.wanted(track[0]):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            state = (st.st_size, st.st_mtime_ns)
+            if self.done.get(entry.path) == state:
+                continue
+            (last, since) = self.seen.get(entry.path, (None, now))
+            if state != last:
+                self.seen[entry.path] = (state, now)
+            elif st.st_size and now - since >= self.settle:
+                del self.seen[entry.path]
+                self.done[entry.path] = state
+                ready.append((*track, entry.path))
+        return sorted(ready, key=lambda x: x[3])
+
+    # --------------------------------------------------------------------
+    # Number of files seen, but not ready yet
+    def waiting(self):
+        return len(self.seen)
+
+
+# ------------------------------------------------------------------------
+# Status of all tracks of a disk, a row per cylinder
+class TrackTable:
+
+    NONE = "."
+    DECODING = "*"
+    OK = "+"
+    FAILED = "X"
+
+    # --------------------------------------------------------------------
+    def __init__(self, cylinders, heads):
+        self.cylinders = cylinders
+        self.heads = heads
+        self.status = [[TrackTable.NONE] * heads for c in range(0, cylinders)]
+
+    # --------------------------------------------------------------------
+    def set(self, cylinder, head, status):
+        # once a track is decoded fine, a new capture can't make it worse
+        if self.status[cylinder][head] == TrackTable.OK and status != TrackTable.OK:
+            return
+        self.status[cylinder][head] = status
+
+    # --------------------------------------------------------------------
+    def cylinder_done(self, cylinder):
+        return all(s in (TrackTable.OK, TrackTable.FAILED) for s in self.status[cylinder])
+
+    # --------------------------------------------------------------------
+    def failed(self):
+        return [
+            (c, h)
+            for c in range(0, self.cylinders)
+            for h in range(0, self.heads)
+            if self.status[c][h] == TrackTable.FAILED
+        ]
+
+    # --------------------------------------------------------------------
+    def count(self, status):
+        return sum(row.count(status) for row in self.status)
+
+    # --------------------------------------------------------------------
+    def row(self, cylinder):
+        return f"{cylinder:3}: {' '.join(self.status[cylinder])}"
+
+    # --------------------------------------------------------------------
+    def format(self):
+        lines = [self.row(c) for c in range(0, self.cylinders) if any(s != TrackTable.NONE for s in self.status[c])]
+        lines.append(f"ok: {self.count(TrackTable.OK)}, failed: {self.count(TrackTable.FAILED)}, decoding: {self.count(TrackTable.DECODING)}")
+        return "\n".join(lines) + "\n"
+
+    # --------------------------------------------------------------------
+    def save(self, file_name):
+        tmp_name = file_name + ".tmp"
+        with open(tmp_name, "w") as f:
+            f.write(self.format())
+        os.replace(tmp_name, file_name)
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
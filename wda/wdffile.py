@@ -0,0 +1,181 @@
+#  Copyright (c) 2013, 2020, 2023 Jakub Filipowicz <jakubf@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import zlib
+import struct
+import hashlib
+import numpy as np
+
+WDF_MAGIC = b"WDF\x1a"
+WDF_VERSION = 1
+WDF_HEADER = struct.Struct("<4sHHBBIQQI20s")
+
+
+# ------------------------------------------------------------------------
+# LEB128 varints: 7 bits per byte, lowest first, high bit set on all
+# but the last byte of a value
+def varint_encode(values):
+    values = np.asarray(values, dtype=np.uint64)
+    size = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        size += rest > 0
+        rest >>= np.uint64(7)
+    pos = np.cumsum(size) - size
+    out = np.zeros(int(size.sum()), dtype=np.uint8)
+    for k in range(0, int(size.max(initial=0))):
+        sel = size > k
+        byte = (values[sel] >> np.uint64(7*k)) & np.uint64(0x7f)
+        more = (size[sel] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[pos[sel] + k] = byte | more
+    return out
+
+
+# ------------------------------------------------------------------------
+def varint_decode(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.int64)
+    last = data < 0x80
+    starts = np.concatenate(([0], np.flatnonzero(last[:-1]) + 1))
+    value = np.concatenate(([0], np.cumsum(last[:-1])))
+    shift = (np.arange(len(data)) - starts[value]) * 7
+    parts = (data & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    return np.add.reduceat(parts, starts).astype(np.int64)
+
+
+# ------------------------------------------------------------------------
+# Flux transitions of a sample array: positions of rising edges (never
+# on the first sample), pulse widths and the length of the pulse that
+# the samples start with
+def flux_from_samples(samples):
+    s = np.asarray(samples, dtype=np.uint8)
+    if not len(s):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0
+    changes = np.flatnonzero(s[1:] != s[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [len(s)]))
+    runs = np.diff(bounds)
+    high = s[bounds[:-1]] == 1
+    first_high = int(runs[0]) if high[0] else 0
+    rising = high.copy()
+    rising[0] = False
+    return bounds[:-1][rising], runs[rising], first_high
+
+
+# ------------------------------------------------------------------------
+def samples_from_flux(edges, widths, first_high, length):
+    delta = np.zeros(length + 1, dtype=np.int8)
+    delta[0] += 1
+    delta[first_high] -= 1
+    delta[edges] += 1
+    delta[edges + widths] -= 1
+    return np.cumsum(delta[:-1], dtype=np.int8).astype(np.uint8)
+
+
+# ------------------------------------------------------------------------
+# Compact track capture: intervals between rising edges and pulse widths,
+# both as varints, compressed with zlib. Header holds sample rate, track
+# C/H, number of samples and edges, and SHA-1 of the source .wds file.
+class WDFFile:
+
+    # --------------------------------------------------------------------
+    def __init__(self, file_name, mapped=False, chunk_size=64*1024):
+        self.chunk_size = chunk_size
+        with open(file_name, "rb") as f:
+            data = f.read()
+        if len(data) < WDF_HEADER.size:
+            raise ValueError(f"{file_name}: not a .wdf file")
+        (magic, version, self.cylinder, self.head, flags, self.sample_rate, self.samples, count, self.first_high, self.source_hash) = WDF_HEADER.unpack_from(data)
+        if magic != WDF_MAGIC or version != WDF_VERSION:
+            raise ValueError(f"{file_name}: not a .wdf file (or unsupported version)")
+
+        try:
+            values = varint_decode(np.frombuffer(zlib.decompress(data[WDF_HEADER.size:]), dtype=np.uint8))
+        except zlib.error:
+            values = []
+        if len(values) != 2 * count:
+            raise ValueError(f"{file_name}: damaged .wdf file")
+        self.__edges = np.cumsum(values[:count])
+        self.__widths = values[count:]
+
+    # --------------------------------------------------------------------
+    def edges(self):
+        return self.__edges
+
+    # --------------------------------------------------------------------
+    def widths(self):
+        return self.__widths
+
+    # --------------------------------------------------------------------
+    def sample_array(self):
+        return samples_from_flux(self.__edges, self.__widths, self.first_high, self.samples)
+
+    # --------------------------------------------------------------------
+    # Samples from start to end, pulse running into the window is dropped
+    def window(self, start, end):
+        (lo, hi) = np.searchsorted(self.__edges, [start, end])
+        edges = self.__edges[lo:hi] - start
+        widths = np.minimum(self.__widths[lo:hi], end - start - edges)
+        return samples_from_flux(edges, widths, 0, end - start)
+
+    # --------------------------------------------------------------------
+    def chunks(self):
+        s = self.sample_array()
+        for pos in range(0, len(s), 8 * self.chunk_size):
+            yield s[pos:pos + 8 * self.chunk_size]
+
+    # --------------------------------------------------------------------
+    def __len__(self):
+        return self.samples
+
+    # --------------------------------------------------------------------
+    def __iter__(self):
+        return (True if v else False for chunk in self.chunks() for v in chunk.tolist())
+
+    # --------------------------------------------------------------------
+    @staticmethod
+    def write(file_name, samples, cylinder=0, head=0, sample_rate=100000000, source_hash=bytes(20)):
+        (edges, widths, first_high) = flux_from_samples(samples)
+        intervals = np.diff(np.concatenate(([0], edges)))
+        body = zlib.compress(varint_encode(np.concatenate((intervals, widths))).tobytes(), 9)
+        header = WDF_HEADER.pack(WDF_MAGIC, WDF_VERSION, cylinder, head, 0, sample_rate, len(samples), len(edges), first_high, source_hash)
+        with open(file_name, "wb") as f:
+            f.write(header + body)
+
+
+# ------------------------------------------------------------------------
+# Convert .wds file into .wdf, returns the number of edges
+def wds_to_wdf(wds_name, wdf_name, cylinder=0, head=0, sample_rate=100000000):
+    with open(wds_name, "rb") as f:
+        data = f.read()
+    samples = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    WDFFile.write(wdf_name, samples, cylinder, head, sample_rate, hashlib.sha1(data).digest())
+    return len(flux_from_samples(samples)[0])
+
+
+# ------------------------------------------------------------------------
+# Convert .wdf file back into .wds, returns True if the result matches
+# the hash of the source .wds file
+def wdf_to_wds(wdf_name, wds_name):
+    wdf = WDFFile(wdf_name)
+    data = np.packbits(wdf.sample_array()).tobytes()
+    with open(wds_name, "wb") as f:
+        f.write(data)
+    return hashlib.sha1(data).digest() == wdf.source_hash
+
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -15,18 +15,48 @@
 #  Foundation, Inc.,
 #  51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import mmap
+import numpy as np
+
 # ------------------------------------------------------------------------
 class WDSFile:
 
     # --------------------------------------------------------------------
-    def __init__(self, file_name):
-        bitorder = [1<<x for x in reversed(range(0, 8))]
+    def __init__(self, file_name, mapped=False, chunk_size=64*1024):
+        self.chunk_size = chunk_size
         with open(file_name, "rb") as f:
+            if not mapped:
+                self.buffer = memoryview(f.read())
+            else:
+                try:
+                    self.buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                except ValueError:
+                    # empty file can't be mapped
+                    self.buffer = memoryview(b"")
+
+        if not mapped:
+            bitorder = [1<<x for x in reversed(range(0, 8))]
             self.bits = (
                 True if data & bit else False
-                for data in f.read()
+                for data in self.buffer
                 for bit in bitorder
             )
+        else:
+            self.bits = (
+                True if v else False
+                for chunk in self.chunks()
+                for v in chunk.tolist()
+            )
+
+    # --------------------------------------------------------------------
+    def chunks(self):
+        # unpack samples in blocks of chunk_size bytes (8 samples per byte)
+        for pos in range(0, len(self.buffer), self.chunk_size):
+            yield np.unpackbits(np.frombuffer(self.buffer[pos:pos+self.chunk_size], dtype=np.uint8))
+
+    # --------------------------------------------------------------------
+    def __len__(self):
+        return 8 * len(self.buffer)
 
     # --------------------------------------------------------------------
     def __iter__(self):